@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Martin Raspaud
+
+# Author(s):
+
+#   Martin Raspaud <martin.raspaud@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Non blocking access to the database.
+
+The calls are queued and run by a few worker threads sharing one pooled
+DCManager, so a service can keep many requests in flight without a thread
+or a connection per request.
+"""
+
+import sys
+from threading import Thread, Event, Lock
+from Queue import Queue
+
+from pytroll_db import DCManager
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Request(object):
+
+    """Pending result of a call submitted to a ConcurrentDCManager.
+    """
+
+    def __init__(self):
+        self._done = Event()
+        self._lock = Lock()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        """Tell if the call is finished.
+        """
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the call to finish and return its result, or raise its
+        exception.
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError("Request not done after " + str(timeout) + "s")
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def add_done_callback(self, callback):
+        """Call *callback* with this request when it is finished. It runs in
+        the worker thread, or right away if the request is already done.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _finish(self, result=None, exc_info=None):
+        with self._lock:
+            self._result = result
+            self._exc_info = exc_info
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                logger.exception("Request callback failed")
+
+
+class ConcurrentDCManager(object):
+
+    """Run DCManager calls in worker threads.
+
+    The create_*, get_*, upsert_files and delete_files methods of DCManager are available
+    with the same arguments, but return a Request right away. Each call runs
+    in its own transaction, committed when it succeeds. The objects it
+    returns are detached from the worker session, so their loaded attributes
+    can be read from any thread but relations are not lazy loaded anymore.
+
+        Parameters :
+            connection_string : str
+                database url
+            workers : int
+                number of worker threads, and of pooled connections
+            max_requests : int
+                number of requests waiting for a worker before submitting
+                blocks, unlimited if 0
+
+    Other keyword arguments are passed to DCManager.
+    """
+
+    def __init__(self, connection_string, workers=4, max_requests=0,
+                 **kwargs):
+        kwargs.setdefault("pool_size", workers)
+        self.dcm = DCManager(connection_string, **kwargs)
+        self._queue = Queue(max_requests)
+        self._workers = []
+        for i in range(workers):
+            worker = Thread(target=self._run, name="dcm-worker-%d" % i)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, method_name, *args, **kwargs):
+        """Queue a call to the DCManager *method_name* and return its Request.
+        """
+        if not hasattr(DCManager, method_name):
+            raise AttributeError("DCManager has no method " + method_name)
+        request = Request()
+        self._queue.put((request, method_name, args, kwargs))
+        return request
+
+    def __getattr__(self, name):
+        if (name.startswith("create_") or name.startswith("get_") or
+                name in ["upsert_files", "delete_files"]):
+            def submitter(*args, **kwargs):
+                return self.submit(name, *args, **kwargs)
+            submitter.__name__ = name
+            return submitter
+        raise AttributeError(name)
+
+    @property
+    def pending(self):
+        """Number of requests waiting for a worker.
+        """
+        return self._queue.qsize()
+
+    def _run(self):
+        session = self.dcm.session
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            request, method_name, args, kwargs = item
+            try:
+                result = getattr(self.dcm, method_name)(*args, **kwargs)
+                # detach the results before the commit expires them
+                session.flush()
+                session.expunge_all()
+                self.dcm.save()
+            except Exception:
+                self.dcm.rollback()
+                request._finish(exc_info=sys.exc_info())
+            else:
+                request._finish(result)
+        self.dcm.close_session()
+
+    def stop(self):
+        """Let the workers finish the queued requests, then stop them.
+        """
+        for worker in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
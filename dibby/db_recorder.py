@@ -25,14 +25,17 @@
 
 from posttroll.subscriber import Subscribe
 from posttroll.message import Message
-from doobie.pytroll_db import DCManager
-from doobie.hl_file import File
-from pyorbital.orbital import Orbital
-from datetime import timedelta
-from pyresample.utils import get_area_def
+from pytroll_db import DCManager
+from hl_file import get_area_ids
+from sat_track import TrackService
+from enrichment import Enricher, get_msg_area_def
 from sqlalchemy.orm.exc import NoResultFound
-from threading import Thread
+from threading import Thread, RLock, Lock
+from Queue import Queue, Full, Empty
+from collections import OrderedDict
 from ConfigParser import ConfigParser
+import os
+import time
 
 import logging
 import logging.handlers
@@ -49,21 +52,369 @@ sat_lookup = {"Suomi-NPP": "SUOMI NPP",
               }
 
 
+def data2record(data):
+    """Make the upsert_files record of the *data* of a file message, leaving
+    out the area and the sub-satellite track.
+    """
+    record = {"uid": data["uid"],
+              "parameters": {},
+              "URIs": []}
+    for key, val in data.items():
+        if key in ["uid", "area"]:
+            continue
+        if key in ["type", "format"]:
+            record[key] = val
+        elif key == "uri":
+            record["URIs"].append(val)
+        else:
+            record["parameters"][key] = val
+    return record
+
+
+class RecentFiles(object):
+
+    """Bounded cache of the recently recorded files, with the message keys
+    and URIs recorded for them.
+
+    At most *size* files are kept, the least recently used ones being
+    forgotten first, and a file is forgotten *ttl* seconds after it was
+    first recorded.
+    """
+
+    def __init__(self, size=10000, ttl=3600):
+        self.size = size
+        self.ttl = ttl
+        self._files = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, uid):
+        """Get the dict of the "keys" and "uris" recorded for *uid*, or None
+        if it is unknown.
+        """
+        with self._lock:
+            entry = self._files.pop(uid, None)
+            if entry is None or time.time() - entry["time"] > self.ttl:
+                return None
+            self._files[uid] = entry
+            return entry
+
+    def add(self, uid, keys, uris):
+        """Remember the message *keys* and the *uris* recorded for *uid*.
+        """
+        with self._lock:
+            entry = self._files.pop(uid, None)
+            if entry is None or time.time() - entry["time"] > self.ttl:
+                entry = {"time": time.time(), "keys": set(), "uris": set()}
+            entry["keys"].update(keys)
+            entry["uris"].update(uris)
+            self._files[uid] = entry
+            while len(self._files) > self.size:
+                self._files.popitem(last=False)
+
+
+class Spool(object):
+
+    """Append-only on-disk queue of (receipt time, message), stored as lines
+    in numbered segment files of *directory*.
+
+    A segment holds at most *segment_size* messages, and written messages are
+    fsync'ed every *sync_every* messages or *sync_interval* seconds. A
+    segment is removed once all its messages are read and acknowledged with
+    done(), so the messages left when the recorder stops or crashes are read
+    again at the next start: they are delivered at least once.
+    """
+
+    def __init__(self, directory, segment_size=10000, sync_every=100,
+                 sync_interval=1.0):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._lock = RLock()
+        self._unread = sorted(int(name[:-len(".spool")])
+                              for name in os.listdir(directory)
+                              if name.endswith(".spool"))
+        # number of messages not read yet, per segment
+        self._unread_count = {}
+        for segment in self._unread[:]:
+            with open(self._path(segment)) as fd_:
+                self._unread_count[segment] = sum(1 for line in fd_)
+            if not self._unread_count[segment]:
+                os.remove(self._path(segment))
+                self._unread.remove(segment)
+                del self._unread_count[segment]
+        self._size = sum(self._unread_count.values())
+        if self._size:
+            logger.info("%d spooled messages to replay", self._size)
+        self._next = self._unread[-1] + 1 if self._unread else 0
+        # number of read messages waiting for done(), per segment
+        self._pending = {}
+        self._write_fd = None
+        self._write_segment = None
+        self._written = 0
+        self._unsynced = 0
+        self._synced = time.time()
+        self._read_fd = None
+        self._read_segment = None
+
+    def __len__(self):
+        """Number of messages not read yet.
+        """
+        return self._size
+
+    def _path(self, segment):
+        return os.path.join(self.directory, "%012d.spool" % segment)
+
+    def put(self, item):
+        """Append the (receipt time, message) *item*.
+        """
+        with self._lock:
+            if self._write_fd is None:
+                self._write_segment = self._next
+                self._next += 1
+                self._write_fd = open(self._path(self._write_segment), "a")
+                self._unread.append(self._write_segment)
+                self._unread_count[self._write_segment] = 0
+                self._written = 0
+            self._write_fd.write("%f %s\n" % (item[0], str(item[1])))
+            self._size += 1
+            self._unread_count[self._write_segment] += 1
+            self._written += 1
+            self._unsynced += 1
+            if (self._unsynced >= self.sync_every or
+                    time.time() - self._synced >= self.sync_interval):
+                self.sync()
+            if self._written >= self.segment_size:
+                self._close_segment()
+
+    def sync(self):
+        """Write the appended messages to disk.
+        """
+        with self._lock:
+            if self._write_fd is not None and self._unsynced:
+                self._write_fd.flush()
+                os.fsync(self._write_fd.fileno())
+            self._unsynced = 0
+            self._synced = time.time()
+
+    def _close_segment(self):
+        self.sync()
+        self._write_fd.close()
+        self._write_fd = None
+        self._write_segment = None
+
+    def get(self):
+        """Read the next message, or return None if there is none.
+
+        Returns the segment of the message, to give to done(), and the
+        (receipt time, message).
+        """
+        with self._lock:
+            while self._size:
+                if self._read_fd is None:
+                    segment = self._unread.pop(0)
+                    if segment == self._write_segment:
+                        # messages are appended to a new segment meanwhile
+                        self._close_segment()
+                    self._read_fd = open(self._path(segment))
+                    self._read_segment = segment
+                    self._pending.setdefault(segment, 0)
+                segment = self._read_segment
+                line = self._read_fd.readline()
+                self._size -= 1
+                self._unread_count[segment] -= 1
+                if not self._unread_count[segment]:
+                    del self._unread_count[segment]
+                    self._read_fd.close()
+                    self._read_fd = None
+                    self._read_segment = None
+                try:
+                    received, rawstr = line.rstrip("\n").split(" ", 1)
+                    item = float(received), Message(rawstr=rawstr)
+                except Exception:
+                    # e.g. the last line written before a crash
+                    logger.warning("Skipping corrupt spooled message: "
+                                   + line)
+                    self._release(segment)
+                    continue
+                self._pending[segment] += 1
+                return segment, item
+            return None
+
+    def done(self, segment):
+        """Acknowledge a message read from *segment*.
+        """
+        with self._lock:
+            self._pending[segment] -= 1
+            self._release(segment)
+
+    def _release(self, segment):
+        if segment != self._read_segment and self._pending[segment] == 0:
+            os.remove(self._path(segment))
+            del self._pending[segment]
+
+    def close(self):
+        """Sync the spool and close its files.
+        """
+        with self._lock:
+            if self._write_fd is not None:
+                self._close_segment()
+            if self._read_fd is not None:
+                self._read_fd.close()
+
+
+class MessageQueue(object):
+
+    """Bounded queue of (receipt time, message) between the receiving and the
+    writing stages.
+
+    The *policy* tells what to do with a new message when the queue is full:
+    "block" waits for room, "drop_oldest" discards the oldest queued message,
+    and "spill" appends it to the *spool*, a Spool from where it is read back
+    once the queue is empty.
+    """
+
+    def __init__(self, maxsize=1000, policy="block", spool=None):
+        if policy not in ["block", "drop_oldest", "spill"]:
+            raise ValueError("Unknown backpressure policy " + str(policy))
+        if policy == "spill" and spool is None:
+            raise ValueError("The spill policy needs a spool")
+        self._queue = Queue(maxsize)
+        self.policy = policy
+        self.spool = spool
+        self.dropped = 0
+        # so a reader finding the spool empty can't miss a message spilled
+        # meanwhile while it waits on the queue
+        self._spill_lock = Lock()
+
+    @property
+    def spilled(self):
+        """Number of spooled messages waiting for a writer.
+        """
+        if self.spool is None:
+            return 0
+        return len(self.spool)
+
+    @property
+    def depth(self):
+        """Number of messages waiting for a writer, spooled ones included.
+        """
+        return self._queue.qsize() + self.spilled
+
+    def put(self, msg, received=None):
+        """Queue *msg*, applying the backpressure policy if the queue is full.
+        """
+        if received is None:
+            received = time.time()
+        item = (received, msg)
+        if self.policy == "block":
+            self._queue.put(item)
+            return
+        if self.policy == "spill":
+            with self._spill_lock:
+                if self.spilled:
+                    # keep the order, the spool is read back before new
+                    # messages
+                    self.spool.put(item)
+                    return
+        try:
+            self._queue.put_nowait(item)
+        except Full:
+            if self.policy == "spill":
+                self.spool.put(item)
+                return
+            try:
+                self._queue.get_nowait()
+                self.dropped += 1
+                logger.warning("Queue full, dropped the oldest message")
+            except Empty:
+                pass
+            self._queue.put(item)
+
+    def get(self, timeout=None, spooled=True):
+        """Get the next (receipt time, message, segment), or raise Empty
+        after *timeout* seconds.
+
+        *segment* is the spool segment of the message, None if it was not
+        spooled, and has to be given to done() once the message is recorded.
+        Spooled messages are left out if *spooled* is False.
+        """
+        # the queued messages are older than the spooled ones, and waiting
+        # is only for when there is neither
+        try:
+            return self._queue.get_nowait() + (None, )
+        except Empty:
+            pass
+        if spooled and self.spool is not None:
+            with self._spill_lock:
+                res = self.spool.get()
+            if res is not None:
+                segment, item = res
+                return item + (segment, )
+        return self._queue.get(timeout=timeout) + (None, )
+
+    def done(self, segments):
+        """Acknowledge recorded messages from their spool *segments*.
+        """
+        for segment in segments:
+            if segment is not None:
+                self.spool.done(segment)
+
+    def close(self):
+        """Close the spool.
+        """
+        if self.spool is not None:
+            self.spool.close()
+
+
 class DBRecorder(object):
 
     """The database recording machine.
 
-    Contains a thread listening to incomming messages, and a thread recording
-    to the database.
+    Contains a thread listening to incomming messages, and *writers* threads
+    recording them to the database. They are joined by a MessageQueue of
+    *queue_size* messages, with the *backpressure* policy of MessageQueue.
+
+    With a *spool_dir*, the batches that can't be written, e.g. because the
+    database is down, are kept in a Spool there and written again once the
+    database is back; the writers wait up to *max_retry_delay* seconds
+    between failing batches meanwhile.
+
+    The last *recent_size* recorded files are remembered for *recent_ttl*
+    seconds in a RecentFiles cache, so the messages announcing them again
+    only add what is new, like another URI.
     """
 
     def __init__(self,
                  (nameserver_address, nameserver_port)=("localhost", 16543),
-                 config_file="db.cfg"):
+                 config_file="db.cfg", batch_size=100, max_latency=1.0,
+                 writers=1, queue_size=1000, backpressure="block",
+                 spool_dir=None, max_retry_delay=60, recent_size=10000,
+                 recent_ttl=3600, deferred_enrichment=False,
+                 enrich_processes=None):
         self.db_thread = Thread(target=self.record)
+        self.writer_threads = [Thread(target=self.write)
+                               for i in range(writers)]
+        spool = None
+        if spool_dir is not None:
+            spool = Spool(spool_dir)
+        self.queue = MessageQueue(queue_size, backpressure, spool)
+        self.max_retry_delay = max_retry_delay
+        self.tracks = TrackService(sat_lookup=sat_lookup)
+        self.recent = RecentFiles(recent_size, recent_ttl)
+        self.deferred_enrichment = deferred_enrichment
+        self.enrich_processes = enrich_processes
+        self.enricher = None
+        self.backfill_thread = None
         self.dbm = None
         self.loop = True
         self._config_file = config_file
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        # seconds spent by the last batch in the queue and in the database
+        self.latency = {"queue": 0.0, "write": 0.0}
 
     def init_db(self):
         config = ConfigParser()
@@ -75,10 +426,50 @@ class DBRecorder(object):
         """Starts the logging.
         """
         self.init_db()
+        if self.deferred_enrichment:
+            self.enricher = Enricher(self.dbm, self.enrich_processes,
+                                     sat_lookup=sat_lookup)
+            self.enricher.start()
+            self.enricher.resume()
+            self.backfill_thread = Thread(target=self.backfill)
+            self.backfill_thread.start()
+        for writer in self.writer_threads:
+            writer.start()
         self.db_thread.start()
 
-    def insert_line(self, msg):
-        """Insert the line corresponding to *msg* in the database.
+    def backfill(self):
+        """Add the missing tracks of the files already in the database,
+        page by page, alongside the recording.
+        """
+        try:
+            self.enricher.add_missing_tracks()
+        except Exception:
+            self.dbm.rollback()
+            logger.exception("Could not add the missing tracks")
+        finally:
+            self.dbm.close_session()
+
+    def stats(self):
+        """Get the state of the recording pipeline.
+        """
+        stats = {"queue_depth": self.queue.depth,
+                 "spilled": self.queue.spilled,
+                 "dropped": self.queue.dropped,
+                 "queue_latency": self.latency["queue"],
+                 "write_latency": self.latency["write"]}
+        if self.enricher is not None:
+            stats.update(("enrichment_" + key, val)
+                         for key, val in self.enricher.stats().items())
+        return stats
+
+    def insert_line(self, msg, deferred=None):
+        """Insert the line corresponding to *msg* in the current transaction of
+        the database manager.
+
+        With deferred enrichment, the track and area jobs of the message are
+        recorded in the transaction too, and appended to the *deferred* list,
+        to be given to the enricher once the transaction is committed, or
+        given to it right away if *deferred* is None.
         """
         if msg.type == "dataset":
 
@@ -88,7 +479,7 @@ class DBRecorder(object):
 
             for item in msg.data["dataset"]:
                 new_msg.data.update(item)
-                self.insert_line(new_msg)
+                self.insert_line(new_msg, deferred)
 
         elif msg.type == "file":
 
@@ -106,86 +497,195 @@ class DBRecorder(object):
             #                     + str(msg))
             #         return
 
+            data = msg.data
+            known = self.recent.get(data["uid"])
+            if known is not None:
+                # e.g. the same file from another distribution host, only
+                # record what is new
+                data = dict((key, val) for key, val in msg.data.items()
+                            if key == "uid" or
+                            (key == "uri" and val not in known["uris"]) or
+                            (key != "uri" and key not in known["keys"]))
+                if len(data) == 1:
+                    logger.debug("Already recorded: " + str(msg))
+                    return
+
+            logger.debug("adding :" + str(msg))
+
+            # one idempotent upsert for the file, its parameters, URI, track
+            # and boundary, so replayed or concurrent messages do no harm
+            record = data2record(data)
+
+            # enrichment jobs, recorded once the file is there
+            enrichment = []
+            if "start_time" in data.keys() and "end_time" in data.keys():
+                if self.enricher is not None:
+                    enrichment.append((self.enricher.track_job,
+                                       (data["uid"], msg.data["platform_name"],
+                                        data["start_time"], data["end_time"])))
+                else:
+                    # compute sub_satellite_track
+                    track = self.tracks.get_track(msg.data["platform_name"],
+                                                  data["start_time"],
+                                                  data["end_time"])
+
+                    logger.debug("Computed sub-satellite track")
+
+                    if track is None:
+                        logger.info("Sub satellite track to short, "
+                                    "skipping it.")
+                    else:
+                        record["sub_satellite_track"] = track
+
+            if "area" in data.keys():
+                if self.enricher is not None:
+                    enrichment.append((self.enricher.area_job,
+                                       (data["uid"], data["area"])))
+                else:
+                    logger.debug("Add area definition to the data")
+                    area_def = get_msg_area_def(data["area"])
+                    srid, record["boundary_id"] = get_area_ids(area_def,
+                                                               self.dbm)
+
             try:
-                file_obj = File(msg.data["uid"], self.dbm,
-                                filetype=msg.data.get("type", None),
-                                fileformat=msg.data.get("format", None))
+                self.dbm.upsert_files([record], skip_unknown=True)
             except NoResultFound:
                 logger.warning("Cannot process: " + str(msg))
                 return
 
-            logger.debug("adding :" + str(msg))
+            # started and remembered once the transaction is committed
+            jobs = [(self.enricher.submit, (make_job(*args), ))
+                    for make_job, args in enrichment]
+            jobs.append((self.recent.add, (data["uid"], data.keys(),
+                                           record["URIs"])))
 
-            for key, val in msg.data.items():
-                if key in ["uid", "type", "area"]:
-                    continue
-                if key == "uri":
-                    file_obj["URIs"] += [val]
-                    continue
-                try:
-                    file_obj[key] = val
-                except NoResultFound:
-                    logger.warning("Cannot add: " + str((key, val)))
-
-            if ("start_time" in msg.data.keys() and
-                    "end_time" in msg.data.keys()):
-                # compute sub_satellite_track
-                satname = msg.data["platform_name"]
-                sat = Orbital(sat_lookup.get(satname, satname))
-                dt_ = timedelta(seconds=10)
-                current_time = msg.data["start_time"]
-                lonlat_list = []
-                while current_time < msg.data["end_time"]:
-                    pos = sat.get_lonlatalt(current_time)
-                    lonlat_list.append(pos[:2])
-                    current_time += dt_
-                pos = sat.get_lonlatalt(msg.data["end_time"])
-                lonlat_list.append(pos[:2])
-
-                logger.debug("Computed sub-satellite track")
-
-                if len(lonlat_list) < 2:
-                    logger.info("Sub satellite track to short, skipping it.")
-                else:
-                    file_obj["sub_satellite_track"] = lonlat_list
-                    logger.debug("Added sub-satellite track")
-
-            if "area" in msg.data.keys():
-                logger.debug("Add area definition to the data")
-                area_def = get_area_def(str(msg.data["area"]["id"]),
-                                        str(msg.data["area"]["name"]),
-                                        str(msg.data["area"]["proj_id"]),
-                                        str(msg.data["area"]["proj4"]),
-                                        msg.data["area"]["shape"][0],
-                                        msg.data["area"]["shape"][1],
-                                        msg.data["area"]["area_extent"])
-                logger.debug("Adding boundary...")
-                file_obj["area"] = area_def
-                logger.debug("Boundary added.")
+            if deferred is None:
+                for add_job, args in jobs:
+                    add_job(*args)
+            else:
+                deferred.extend(jobs)
+
+    def insert_batch(self, msgs):
+        """Insert the lines corresponding to *msgs* in one transaction.
+
+        Each message is inserted within a savepoint, so a failing message is
+        logged and skipped without losing the rest of the batch.
+        """
+        deferred = []
+        for msg in msgs:
+            jobs = []
+            self.dbm.session.begin_nested()
+            try:
+                self.insert_line(msg, jobs)
+                self.dbm.session.commit()
+            except Exception:
+                logger.exception("Cannot insert " + str(msg))
+                self.dbm.session.rollback()
+            else:
+                deferred.extend(jobs)
+        self.dbm.save()
+        for add_job, args in deferred:
+            add_job(*args)
+        logger.debug("Inserted a batch of %d messages", len(msgs))
 
     def record(self):
         """Log stuff.
+
+        Received messages are only queued here, the writers insert them. The
+        subscription is made again if it fails.
+        """
+        while self.loop:
+            try:
+                with Subscribe("", addr_listener=True) as sub:
+                    for msg in sub.recv(timeout=1):
+                        if msg:
+                            logger.debug("got msg %s", str(msg))
+                            self.queue.put(msg)
+                        if not self.loop:
+                            logger.info("Stop recording")
+                            break
+            except Exception:
+                logger.exception("Something went wrong in record")
+                time.sleep(1)
+
+    def write(self):
+        """Insert the queued messages in the database.
+
+        Messages are inserted by batches of at most *batch_size*, at most
+        *max_latency* seconds after the writer took the first one. The
+        writer drains the queue before stopping, leaving the spool for the
+        next start.
+        """
+        batch = []
+        segments = []
+        batch_start = None
+        oldest = None
+        retry_delay = 1
+        while self.loop or batch or self.queue.depth - self.queue.spilled:
+            try:
+                received, msg, segment = self.queue.get(
+                    timeout=min(1, self.max_latency), spooled=self.loop)
+            except Empty:
+                idle = True
+            else:
+                idle = False
+                if not batch:
+                    batch_start = time.time()
+                    oldest = received
+                batch.append((received, msg))
+                segments.append(segment)
+            if batch and (len(batch) >= self.batch_size or
+                          (idle and not self.loop) or
+                          time.time() - batch_start >= self.max_latency):
+                self.latency["queue"] = batch_start - oldest
+                write_start = time.time()
+                try:
+                    self.insert_batch([msg for received, msg in batch])
+                except Exception:
+                    self._spool_batch(batch)
+                    if self.loop:
+                        time.sleep(retry_delay)
+                        retry_delay = min(2 * retry_delay,
+                                          self.max_retry_delay)
+                else:
+                    retry_delay = 1
+                self.queue.done(segments)
+                self.latency["write"] = time.time() - write_start
+                batch = []
+                segments = []
+        self.dbm.close_session()
+
+    def _spool_batch(self, batch):
+        """Keep a *batch* of (receipt time, message) that could not be
+        written, to write it again later.
         """
         try:
-            with Subscribe("", addr_listener=True) as sub:
-                for msg in sub.recv(timeout=1):
-                    if msg:
-                        logger.debug("got msg %s", str(msg))
-                        self.insert_line(msg)
-                    if not self.loop:
-                        logger.info("Stop recording")
-                        break
-        except:
-            logger.exception("Something went wrong in record")
-            raise
+            self.dbm.rollback()
+        except Exception:
+            pass
+        if self.queue.spool is None:
+            logger.exception("Could not insert a batch of %d messages",
+                             len(batch))
+            return
+        logger.exception("Could not insert a batch of %d messages, "
+                         "spooling it", len(batch))
+        for item in batch:
+            self.queue.spool.put(item)
+        self.queue.spool.sync()
 
     def stop(self):
         """Stop the machine.
         """
         self.loop = False
+        for writer in self.writer_threads:
+            writer.join()
+        if self.enricher is not None:
+            self.enricher.stop()
+        if self.backfill_thread is not None:
+            self.backfill_thread.join()
+        self.queue.close()
 
 if __name__ == '__main__':
-    import time
     from logging import Formatter
 
     logger = logging.getLogger("db_recorder")
@@ -233,3 +733,4 @@ if __name__ == '__main__':
 # m.data = eval(m.data)
 
 # rec.insert_line(m)
+# rec.dbm.save()
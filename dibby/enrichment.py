@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Martin Raspaud
+
+# Author(s):
+
+#   Martin Raspaud <martin.raspaud@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Deferred geometry enrichment of the recorded files.
+
+The files are recorded first, and their sub-satellite tracks and area
+boundaries are added afterwards: the tracks are computed in a pool of
+processes, and a thread writes tracks and boundaries to the database,
+retrying the ones that fail. The jobs are kept in the enrichment_job table
+until they are done, so the ones left pending are started again at the next
+start, and the failed or skipped ones are not.
+"""
+
+import json
+import time
+import traceback
+from datetime import datetime
+from multiprocessing import Pool
+from threading import Thread, Timer, Lock
+from Queue import Queue
+
+import numpy as np
+from pyresample.utils import get_area_def
+from sqlalchemy import and_, exists
+
+import pytroll_db as db
+from hl_file import File
+from sat_track import TrackService
+
+import logging
+logger = logging.getLogger(__name__)
+
+# track service of a pool process
+_tracks = None
+
+# status of the jobs in the enrichment_job table, done jobs are removed
+PENDING = "pending"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+# number of files whose missing tracks are added at once
+BACKFILL_PAGE = 1000
+
+
+def get_msg_area_def(area):
+    """Get the pyresample area definition described by the *area* dict of a
+    message.
+    """
+    return get_area_def(str(area["id"]),
+                        str(area["name"]),
+                        str(area["proj_id"]),
+                        str(area["proj4"]),
+                        area["shape"][0],
+                        area["shape"][1],
+                        area["area_extent"])
+
+
+def init_track_process(sat_lookup):
+    """Set up the track service of a pool process.
+    """
+    global _tracks
+    _tracks = TrackService(sat_lookup=sat_lookup)
+
+
+def compute_track(platform_name, start_time, end_time):
+    """Compute a track in a pool process.
+
+    Returns the array of lon/lat pairs (None if the track is too short) and
+    the formatted exception if it failed.
+    """
+    try:
+        lons, lats = _tracks.get_lonlats(platform_name, start_time, end_time)
+    except Exception:
+        return None, traceback.format_exc()
+    if len(lons) < 2:
+        return None, None
+    return np.column_stack((lons, lats)), None
+
+
+class Job(object):
+
+    """Enrichment of the file *uid*, *kind* being "track" or "area".
+    """
+
+    def __init__(self, uid, kind, args, attempts=0):
+        self.uid = uid
+        self.kind = kind
+        self.args = args
+        self.attempts = attempts
+
+    def to_row(self, status=PENDING):
+        """Get the enrichment_job row of the job.
+        """
+        return db.EnrichmentJob(self.uid, self.kind,
+                                json.dumps(self.args, default=_format_time),
+                                status, self.attempts, datetime.utcnow())
+
+    @classmethod
+    def from_row(cls, row):
+        """Get the job of an enrichment_job *row*.
+        """
+        args = json.loads(row.args)
+        if row.kind == "track":
+            args = (args[0], _parse_time(args[1]), _parse_time(args[2]))
+        return cls(row.uid, row.kind, tuple(args), row.attempts)
+
+
+def _format_time(obj):
+    return obj.isoformat()
+
+
+def _parse_time(text):
+    try:
+        return datetime.strptime(text, "%Y-%m-%dT%H:%M:%S.%f")
+    except ValueError:
+        return datetime.strptime(text, "%Y-%m-%dT%H:%M:%S")
+
+
+class Enricher(object):
+
+    """Add tracks and area boundaries to recorded files.
+
+    A failing job is tried again after *retry_delay* seconds, at most
+    *retries* times. The jobs still pending when the enricher is stopped
+    are left in the database for resume(). The files must be committed
+    before their jobs are added.
+    """
+
+    def __init__(self, dbm, processes=None, retries=3, retry_delay=10,
+                 sat_lookup=None):
+        self.dbm = dbm
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._pool = Pool(processes, initializer=init_track_process,
+                          initargs=(sat_lookup, ))
+        self._results = Queue()
+        self._thread = Thread(target=self.run)
+        self._lock = Lock()
+        self._stopped = False
+        # retry timers, by (uid, kind) of their job
+        self._timers = {}
+        self.pending = 0
+        self.done = 0
+        self.failed = 0
+        self.retried = 0
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """Finish the running jobs and stop, leaving the ones waiting for a
+        retry in the database.
+        """
+        with self._lock:
+            self._stopped = True
+            for timer in self._timers.values():
+                timer.cancel()
+            self.pending -= len(self._timers)
+            self._timers.clear()
+        self._pool.close()
+        self._pool.join()
+        self._results.put(None)
+        self._thread.join()
+
+    def stats(self):
+        """Get the number of pending, done, failed and retried jobs.
+        """
+        return {"pending": self.pending,
+                "done": self.done,
+                "failed": self.failed,
+                "retried": self.retried}
+
+    def track_job(self, uid, platform_name, start_time, end_time):
+        """Make the job adding the sub-satellite track of the file *uid*, and
+        record it in the current transaction of the manager. It is to be
+        given to submit() once committed.
+        """
+        return self._new_job(Job(uid, "track",
+                                 (platform_name, start_time, end_time)))
+
+    def area_job(self, uid, area):
+        """Make the job adding the boundary of the *area* dict of a message to
+        the file *uid*, like track_job().
+        """
+        return self._new_job(Job(uid, "area", (area, )))
+
+    def _new_job(self, job):
+        # a replayed message starts its jobs over
+        self.dbm.session.merge(job.to_row())
+        return job
+
+    def submit(self, job):
+        """Start the committed *job*.
+        """
+        with self._lock:
+            self.pending += 1
+        self._submit(job)
+
+    def add_track(self, uid, platform_name, start_time, end_time):
+        """Add the sub-satellite track of the file *uid*, committing the job
+        right away.
+        """
+        job = self.track_job(uid, platform_name, start_time, end_time)
+        self.dbm.save()
+        self.submit(job)
+
+    def add_area(self, uid, area):
+        """Add the boundary of the *area* dict of a message to the file *uid*,
+        committing the job right away.
+        """
+        job = self.area_job(uid, area)
+        self.dbm.save()
+        self.submit(job)
+
+    def resume(self):
+        """Start the jobs left pending, e.g. when the recorder stopped.
+        """
+        jobs = [Job.from_row(row) for row in
+                self.dbm.session.query(db.EnrichmentJob).filter(
+                    db.EnrichmentJob.status == PENDING)]
+        self.dbm.rollback()
+        for job in jobs:
+            self.submit(job)
+        logger.info("Resumed %d pending jobs", len(jobs))
+        return len(jobs)
+
+    def add_missing_tracks(self, file_type_name=None, page_size=BACKFILL_PAGE):
+        """Add the tracks of the files which have a sensing time but neither
+        a track nor a track job yet, e.g. the ones recorded without the
+        enricher.
+
+        The files are taken by pages of *page_size*, the next page waiting
+        for less than *page_size* jobs to be pending, until the enricher is
+        stopped.
+        """
+        query = self.dbm.session.query(db.File.uid, db.File.start_time,
+                                       db.File.end_time,
+                                       db.ParameterValue.data_value).\
+            join(db.File.parameter_values).\
+            join(db.ParameterValue.parameter).\
+            filter(db.Parameter.parameter_name == "platform_name").\
+            filter(db.File.start_time != None).\
+            filter(db.File.end_time != None).\
+            filter(~db.File.parameter_linestrings.any()).\
+            filter(~exists().where(and_(db.EnrichmentJob.uid == db.File.uid,
+                                        db.EnrichmentJob.kind == "track")))
+        if file_type_name is not None:
+            query = query.join(db.File.file_type).\
+                filter(db.FileType.file_type_name == file_type_name)
+        query = query.order_by(db.File.uid)
+        cnt = 0
+        last = None
+        while not self._stopped:
+            page = query
+            if last is not None:
+                page = page.filter(db.File.uid > last)
+            rows = page.limit(page_size).all()
+            if not rows:
+                break
+            jobs = [self.track_job(uid, platform_name, start_time, end_time)
+                    for uid, start_time, end_time, platform_name in rows]
+            self.dbm.save()
+            for job in jobs:
+                self.submit(job)
+            cnt += len(jobs)
+            last = rows[-1][0]
+            while self.pending >= page_size and not self._stopped:
+                time.sleep(1)
+        logger.info("Added %d missing tracks", cnt)
+        return cnt
+
+    def _submit(self, job):
+        with self._lock:
+            if self._stopped:
+                # left pending in the database for the next start
+                self.pending -= 1
+                return
+            job.attempts += 1
+            # under the lock, so the pool is not closed meanwhile
+            if job.kind == "track":
+                self._pool.apply_async(compute_track, job.args,
+                                       callback=lambda res: self._results.put(
+                                           (job, res)))
+            else:
+                self._results.put((job, None))
+
+    def _resubmit(self, job):
+        with self._lock:
+            if self._timers.pop((job.uid, job.kind), None) is None:
+                # cancelled by stop()
+                return
+        self._submit(job)
+
+    def run(self):
+        """Write the results of the jobs to the database.
+        """
+        while True:
+            item = self._results.get()
+            if item is None:
+                break
+            job, res = item
+            try:
+                self._write(job, res)
+            except Exception:
+                self.dbm.rollback()
+                logger.exception("Enrichment of %s failed", job.uid)
+                self._retry(job)
+            else:
+                with self._lock:
+                    self.pending -= 1
+                    self.done += 1
+        self.dbm.close_session()
+
+    def _write(self, job, res):
+        if job.kind == "track":
+            lonlats, error = res
+            if error is not None:
+                raise RuntimeError("Track computation failed:\n" + error)
+            if lonlats is None:
+                logger.info("Sub satellite track to short, skipping it.")
+                self._set_status(job, SKIPPED)
+                return
+            file_obj = File(job.uid, self.dbm, autosave=False)
+            file_obj["sub_satellite_track"] = lonlats
+        else:
+            file_obj = File(job.uid, self.dbm, autosave=False)
+            file_obj["area"] = get_msg_area_def(job.args[0])
+        # done in the same transaction as the job results
+        self._job_query(job).delete(synchronize_session=False)
+        self.dbm.save()
+        logger.debug("Added %s to %s", job.kind, job.uid)
+
+    def _job_query(self, job):
+        return self.dbm.session.query(db.EnrichmentJob).filter(
+            db.EnrichmentJob.uid == job.uid,
+            db.EnrichmentJob.kind == job.kind)
+
+    def _set_status(self, job, status):
+        """Save the *status* and attempts of *job* in the database.
+        """
+        self._job_query(job).update({"status": status,
+                                     "attempts": job.attempts,
+                                     "updated": datetime.utcnow()},
+                                    synchronize_session=False)
+        self.dbm.save()
+
+    def _retry(self, job):
+        if self._stopped:
+            logger.info("Leaving the %s of %s for the next start",
+                        job.kind, job.uid)
+            with self._lock:
+                self.pending -= 1
+            return
+        gave_up = job.attempts > self.retries
+        try:
+            self._set_status(job, FAILED if gave_up else PENDING)
+        except Exception:
+            self.dbm.rollback()
+            logger.exception("Could not save the state of the %s of %s",
+                             job.kind, job.uid)
+        if gave_up:
+            logger.error("Giving up the %s of %s", job.kind, job.uid)
+            with self._lock:
+                self.pending -= 1
+                self.failed += 1
+            return
+        with self._lock:
+            if self._stopped:
+                self.pending -= 1
+                return
+            self.retried += 1
+            timer = Timer(self.retry_delay, self._resubmit, (job, ))
+            timer.daemon = True
+            self._timers[(job.uid, job.kind)] = timer
+            timer.start()
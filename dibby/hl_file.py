@@ -22,9 +22,12 @@
 
 
 import pytroll_db as db
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, joinedload_all
 from sqlalchemy.orm.exc import NoResultFound
-from datetime import datetime
-import shapely
+from threading import Lock
+import shapely.geometry
 import numpy as np
 from geoalchemy2.shape import from_shape
 
@@ -32,17 +35,31 @@ from geoalchemy2.shape import from_shape
 import logging
 logger = logging.getLogger(__name__)
 
+# (srid, boundary_id) of the area definitions already in the db, by area id,
+# name, proj4 string and extent, shared by all the threads of the process
+_area_ids = {}
+_area_lock = Lock()
+
 
 def area_def2boundary(area_def, boundary_id, session):
     """Convert a pyresample *area_def* to a db Boundary object
     """
+    return db.Boundary(boundary_id, area_def.name,
+                       area_def2polygon(area_def, session))
+
+
+def area_def2polygon(area_def, session):
+    """Get the polygon of the extent of a pyresample *area_def*, in its
+    spatial reference system, adding the latter to the db if needed.
+    """
 
     # check if srid is there, otherwise add it
 
-    try:
-        new_srs = session.query(db.SpatialRefSys).filter_by(
-            proj4text=area_def.proj4_string).one()
-    except NoResultFound:
+    # concurrent recorders may have added it twice, take the first one
+    new_srs = session.query(db.SpatialRefSys).\
+        filter_by(proj4text=area_def.proj4_string).\
+        order_by(db.SpatialRefSys.srid).first()
+    if new_srs is None:
         logger.debug("Can't find srid, adding it")
         # add it
         from osgeo import osr
@@ -54,11 +71,10 @@ def area_def2boundary(area_def, boundary_id, session):
         except KeyError:
             pass
         wkt = srs.ExportToWkt()
-        last_srid = session.query(db.SpatialRefSys).order_by(
-            db.SpatialRefSys.srid.desc()).first().srid
-        new_srs = db.SpatialRefSys(srid=last_srid + 1,
+        srid = session.scalar(select([db.smhi_srid_seq.next_value()]))
+        new_srs = db.SpatialRefSys(srid=srid,
                                    auth_name="smhi",
-                                   auth_srid=last_srid + 1,
+                                   auth_srid=srid,
                                    srtext=wkt,
                                    proj4text=area_def.proj4_string)
         session.add(new_srs)
@@ -81,106 +97,224 @@ def area_def2boundary(area_def, boundary_id, session):
 
     poly = shapely.geometry.asPolygon(corners)
 
-    wkb = from_shape(poly, srid=new_srs.srid)
-    return db.Boundary(boundary_id, area_def.name, wkb)
+    return from_shape(poly, srid=new_srs.srid)
+
+
+def get_area_ids(area_def, dbm):
+    """Get the (srid, boundary_id) of the pyresample *area_def*, adding its
+    spatial reference system and boundary to the db if needed.
+
+    A boundary matches the name and the polygon of the area definition, so
+    a changed definition gets a new boundary. They are added in a session of
+    their own, committed right away, so the result can be remembered for the
+    whole process.
+    """
+    key = (area_def.area_id, area_def.name, area_def.proj4_string,
+           tuple(area_def.area_extent))
+    with _area_lock:
+        try:
+            return _area_ids[key]
+        except KeyError:
+            pass
+        session = dbm.new_session()
+        try:
+            try:
+                ids = _area_ids_in_db(area_def, dbm, session)
+            except IntegrityError:
+                # added meanwhile by another recorder, so it is there now
+                session.rollback()
+                ids = _area_ids_in_db(area_def, dbm, session)
+        finally:
+            session.close()
+        _area_ids[key] = ids
+        return ids
+
+
+def _area_ids_in_db(area_def, dbm, session):
+    """Get the (srid, boundary_id) of *area_def* like get_area_ids, in
+    *session*.
+    """
+    polygon = area_def2polygon(area_def, session)
+    # compared as ewkb, like in the boundary_idx unique index
+    bid = session.query(db.Boundary.boundary_id).filter(
+        db.Boundary.boundary_name == area_def.name).filter(
+        func.ST_AsEWKB(db.Boundary.boundary) ==
+        func.ST_AsEWKB(polygon)).scalar()
+    if bid is None:
+        bid = dbm.next_id(db.Boundary)
+        session.add(db.Boundary(bid, area_def.name, polygon))
+    session.commit()
+    return polygon.srid, bid
 
 
 class File(object):
 
-    def __init__(self, uid, dbm, filetype=None, fileformat=None):
+    """High level access to the db File *uid*, like to a dict.
+
+    The file is created if it is missing and *filetype* and *fileformat* are
+    given, otherwise a missing file raises NoResultFound.
+
+    Changes are committed right away, unless *autosave* is False, in which
+    case they are left in the current transaction of *dbm*. Used as a
+    context manager, the changes made in the with block are buffered and
+    written with update() when it ends.
+
+    All the values are read in one query at the first read, and then served
+    from memory until the next change or refresh().
+    """
+
+    def __init__(self, uid, dbm, filetype=None, fileformat=None,
+                 autosave=True):
         self.uid = uid
         self.dbm = dbm
+        self.autosave = autosave
+        # changes buffered in a with block
+        self._pending = None
+        # values read with prefetch()
+        self._values = None
+        if filetype is not None and fileformat is not None:
+            # the file may be created concurrently, e.g. by another recorder
+            self.dbm.upsert_files([{"uid": uid,
+                                    "type": filetype,
+                                    "format": fileformat}])
+            if self.autosave:
+                self.dbm.save()
         try:
             self._file = dbm.session.query(db.File).\
                 filter(db.File.uid == self.uid).one()
         except NoResultFound:
-            self._file = self.dbm.create_file(self.uid,
-                                              file_type_name=filetype,
-                                              file_format_name=fileformat,
-                                              creation_time=datetime.utcnow())
-            self.dbm.save()
-
-    def add_bound(self, area_def):
-        # find if the boundary is already there
-        try:
-            bound = self.dbm.session.query(db.Boundary).filter(
-                db.Boundary.boundary_name == area_def.name).one()
-        except NoResultFound:
-            try:
-                bid = self.dbm.session.query(db.Boundary).order_by(
-                    db.Boundary.boundary_id.desc()).first().boundary_id + 1
-            except AttributeError:
-                bid = 1
-            bound = area_def2boundary(area_def, bid, self.dbm.session)
-            self.dbm.session.add(bound)
-        self._file.boundary.append(bound)
-        self.dbm.save()
+            raise NoResultFound("No file " + str(uid) + ", its type and "
+                                "format are needed to create it")
 
-    def __setitem__(self, key, val):
+    def __enter__(self):
+        self._pending = {}
+        return self
 
-        if key == "URIs":
-            uris = self.dbm.session.query(db.FileURI).\
-                filter(db.FileURI.uid == self.uid).all()
-            uri_vals = [i.uri for i in uris]
+    def __exit__(self, exc_type, exc_value, traceback):
+        pending, self._pending = self._pending, None
+        if exc_type is None:
+            self.update(pending)
 
-            # adding new uris
-            for uri in val:
-                if uri not in uri_vals:
-                    self.dbm.create_file_uri(uid=self.uid, URI=uri)
-            # deleting old uris
-            for uri, uri_obj in zip(uri_vals, uris):
-                if uri not in val:
-                    self.dbm.session.delete(uri_obj)
-
-        elif key == "format":
-            fileformat = self.dbm.get_file_format(val)
-            self._file.file_format = fileformat
-
-        elif key == "type":
-            filetype = self.dbm.get_file_format(val)
-            self._file.file_type = filetype
-
-        elif key == "area":
-            self.add_bound(val)
-
-        elif key == "sub_satellite_track":
-            value = 'LINESTRING ('
-            for i, item in enumerate(val):
-                if i == 0:
-                    value += '%s %s' % (item[0], item[1])
+    def add_bound(self, area_def):
+        self["area"] = area_def
+
+    def update(self, values):
+        """Set the items of the *values* dict at once: the parameters, URIs,
+        track and area are written with one upsert, and committed once.
+        """
+        if self._pending is not None:
+            self._pending.update(values)
+            return
+
+        record = {"uid": self.uid, "parameters": {}}
+        for key, val in values.items():
+            if key == "URIs":
+                record["URIs"] = val
+            elif key == "format":
+                self._file.file_format = self.dbm.get_file_format(val)
+            elif key == "type":
+                self._file.file_type = self.dbm.get_file_type(val)
+            elif key == "area":
+                srid, record["boundary_id"] = get_area_ids(val, self.dbm)
+            elif key == "sub_satellite_track":
+                # a linestring, or a sequence or array of lon/lat pairs
+                if isinstance(val, shapely.geometry.LineString):
+                    record[key] = val
                 else:
-                    value += ', %s %s' % (item[0], item[1])
-            value += ')'
+                    record[key] = shapely.geometry.LineString(val)
+            else:
+                # existing values are kept, like the sensing interval
+                record["parameters"][key] = val
 
-            wkt_o = shapely.wkt.loads(value)
-            p_track = self.dbm.get_parameter('sub_satellite_track')
-            try:
-                self.dbm.session.query(db.ParameterLinestring).join(db.Parameter).filter(
-                    db.ParameterLinestring.uid == self.uid).filter(db.Parameter.parameter_name == key).one().data_value
-            except NoResultFound:
-                self.dbm.create_parameter_linestring(wkt_o,
-                                                     uid=self.uid,
-                                                     parameter=p_track)
-
-        else:
-            try:
-                self.dbm.session.query(db.ParameterValue).join(db.Parameter).filter(
-                    db.ParameterValue.uid == self.uid).filter(db.Parameter.parameter_name == key).one().data_value
-            except NoResultFound:
-                self.dbm.create_parameter_value(uid=self.uid,
-                                                parameter_name=key,
-                                                data_value=val,
-                                                creation_time=datetime.utcnow())
+        self.dbm.upsert_files([record])
+        if "URIs" in values:
+            # deleting old uris
+            query = self.dbm.session.query(db.FileURI).\
+                filter(db.FileURI.uid == self.uid)
+            if values["URIs"]:
+                query = query.filter(~db.FileURI.uri.in_(values["URIs"]))
+            query.delete(synchronize_session=False)
+        self.dbm.session.expire(self._file, ["start_time", "end_time",
+                                             "boundary"])
+        self._values = None
+
+        if self.autosave:
+            self.dbm.save()
 
-        self.dbm.save()
+    def __setitem__(self, key, val):
+        self.update({key: val})
+
+    @classmethod
+    def load_many(cls, uids, dbm, autosave=True):
+        """Get the File objects of *uids* as a dict, with the values of all
+        of them read in one query per page of files. Unknown uids are left
+        out.
+        """
+        uids = list(uids)
+        files = {}
+        for i in range(0, len(uids), db.FILES_PAGE_SIZE):
+            query = _values_query(dbm.session).\
+                filter(db.File.uid.in_(uids[i:i + db.FILES_PAGE_SIZE]))
+            for file_obj in query:
+                obj = cls.__new__(cls)
+                obj.uid = file_obj.uid
+                obj.dbm = dbm
+                obj.autosave = autosave
+                obj._pending = None
+                obj._file = file_obj
+                obj._values = _file_values(file_obj)
+                files[obj.uid] = obj
+        return files
+
+    def prefetch(self):
+        """Read the type, format, URIs and parameter values of the file in
+        one query. They are then read from memory, until the next change.
+        """
+        self._file = _values_query(self.dbm.session).\
+            filter(db.File.uid == self.uid).one()
+        self._values = _file_values(self._file)
+
+    def refresh(self):
+        """Read the values of the file again, e.g. after it was changed by
+        someone else.
+        """
+        self.prefetch()
+
+    def to_dict(self):
+        """Get the type, format, URIs and parameter values of the file.
+        """
+        if self._values is None:
+            self.prefetch()
+        return dict(self._values)
 
     def __getitem__(self, key):
+        if self._values is None:
+            self.prefetch()
+        try:
+            return self._values[key]
+        except KeyError:
+            raise NoResultFound("No " + str(key) + " for " + self.uid)
 
-        if key == "URIs":
-            return [i.uri for i in self.dbm.session.query(db.FileURI).filter(db.FileURI.uid == self.uid)]
-        elif key == "type":
-            return self._file.file_type.file_type_name
-        elif key == "format":
-            return self._file.file_format.file_format_name
-        else:
-            return self.dbm.session.query(db.ParameterValue).join(db.Parameter).filter(db.ParameterValue.uid == self.uid).filter(db.Parameter.parameter_name == key).one().data_value
+
+def _values_query(session):
+    """Query files, eager loading their type, format, URIs and parameter
+    values.
+    """
+    return session.query(db.File).\
+        options(joinedload(db.File.file_type),
+                joinedload(db.File.file_format),
+                joinedload(db.File.uris),
+                joinedload_all("parameter_values.parameter")).\
+        populate_existing()
+
+
+def _file_values(file_obj):
+    """Get the type, format, URIs and parameter values of the loaded
+    *file_obj* as a dict.
+    """
+    values = dict((val.parameter.parameter_name, val.data_value)
+                  for val in file_obj.parameter_values)
+    values["type"] = file_obj.file_type.file_type_name
+    values["format"] = file_obj.file_format.file_format_name
+    values["URIs"] = [uri.uri for uri in file_obj.uris]
+    return values
@@ -0,0 +1,13 @@
+-- Make the boundaries unique on their name and polygon, instead of their
+-- name only, so a changed area definition gets a new boundary while the
+-- files of the old one keep theirs.
+
+BEGIN;
+
+DROP INDEX public.boundary_idx;
+
+CREATE UNIQUE INDEX boundary_idx
+ ON public.boundary
+ ( boundary_name, md5(ST_AsEWKB(boundary)) );
+
+COMMIT;
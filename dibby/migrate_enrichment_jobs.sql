@@ -0,0 +1,28 @@
+-- Add the table keeping the deferred track and area jobs of the enricher
+-- until they are done, and the ones failed or skipped, so they are not
+-- tried again at every start.
+
+BEGIN;
+
+CREATE TABLE public.enrichment_job (
+                uid VARCHAR(255) NOT NULL,
+                kind VARCHAR(16) NOT NULL,
+                args TEXT,
+                status VARCHAR(16) NOT NULL,
+                attempts INTEGER NOT NULL,
+                updated TIMESTAMP,
+                CONSTRAINT enrichment_job_pk PRIMARY KEY (uid, kind)
+);
+
+CREATE INDEX enrichment_job_status_idx
+ ON public.enrichment_job
+ ( status );
+
+ALTER TABLE public.enrichment_job ADD CONSTRAINT file_enrichment_job_fk
+FOREIGN KEY (uid)
+REFERENCES public.file (uid)
+ON DELETE CASCADE
+ON UPDATE NO ACTION
+NOT DEFERRABLE;
+
+COMMIT;
@@ -0,0 +1,7 @@
+-- Index the files on (creation_time, uid), the key of the pages read by
+-- DCManager.iter_files. CONCURRENTLY does not lock the table for writes, so
+-- it is not run in a transaction.
+
+CREATE INDEX CONCURRENTLY file_creation_idx
+ ON public.file
+ ( creation_time, uid );
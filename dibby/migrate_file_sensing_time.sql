@@ -0,0 +1,30 @@
+-- Add the sensing interval columns to file, fill them in from the
+-- start_time and end_time parameter values, and index them as a tsrange
+-- for overlap queries. Files without a sensing interval, or with a reversed
+-- one, are left out of the index. Run it after
+-- migrate_typed_parameter_values.sql.
+
+BEGIN;
+
+ALTER TABLE public.file ADD COLUMN start_time TIMESTAMP;
+ALTER TABLE public.file ADD COLUMN end_time TIMESTAMP;
+
+UPDATE public.file f
+ SET start_time = COALESCE(pv.time_value, pv.data_value::timestamp)
+ FROM public.parameter_value pv, public.parameter p
+ WHERE pv.uid = f.uid
+   AND pv.parameter_id = p.parameter_id
+   AND p.parameter_name = 'start_time'
+   AND pv.data_value ~ '^[0-9]{4}-[0-9]{2}-[0-9]{2}';
+UPDATE public.file f
+ SET end_time = COALESCE(pv.time_value, pv.data_value::timestamp)
+ FROM public.parameter_value pv, public.parameter p
+ WHERE pv.uid = f.uid
+   AND pv.parameter_id = p.parameter_id
+   AND p.parameter_name = 'end_time'
+   AND pv.data_value ~ '^[0-9]{4}-[0-9]{2}-[0-9]{2}';
+
+CREATE INDEX file_sensing_gix ON file USING GIST (tsrange(start_time, end_time, '[]'))
+ WHERE start_time IS NOT NULL AND end_time IS NOT NULL AND start_time <= end_time;
+
+COMMIT;
@@ -0,0 +1,7 @@
+-- Index the uris on their own, to find the uris of deleted files, or the
+-- ones under a directory, without scanning file_uri. CONCURRENTLY does not
+-- lock the table for writes, so it is not run in a transaction.
+
+CREATE INDEX CONCURRENTLY file_uri_uri_idx
+ ON public.file_uri
+ ( uri varchar_pattern_ops );
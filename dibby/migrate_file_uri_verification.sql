@@ -0,0 +1,13 @@
+-- Add the verification time and status of the uris, set by the incremental
+-- cleanup, and index them so the least recently verified uris come first.
+
+BEGIN;
+
+ALTER TABLE public.file_uri ADD COLUMN last_verified TIMESTAMP;
+ALTER TABLE public.file_uri ADD COLUMN last_status BOOLEAN;
+
+CREATE INDEX file_uri_verified_idx
+ ON public.file_uri
+ ( last_verified, uid, uri );
+
+COMMIT;
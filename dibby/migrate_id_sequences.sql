@@ -0,0 +1,44 @@
+-- Add the sequences the ids of new boundaries, spatial reference systems,
+-- file types and formats, parameter types and parameters are taken from,
+-- starting after the ids already in use.
+
+BEGIN;
+
+CREATE SEQUENCE public.boundary_boundary_id_seq;
+CREATE SEQUENCE public.parameter_type_parameter_type_id_seq;
+CREATE SEQUENCE public.parameter_parameter_id_seq;
+CREATE SEQUENCE public.file_format_file_format_id_seq;
+CREATE SEQUENCE public.file_type_file_type_id_seq;
+CREATE SEQUENCE public.smhi_srid_seq;
+
+SELECT setval('public.boundary_boundary_id_seq',
+              COALESCE((SELECT max(boundary_id) FROM public.boundary), 0) + 1,
+              false);
+SELECT setval('public.parameter_type_parameter_type_id_seq',
+              COALESCE((SELECT max(parameter_type_id) FROM public.parameter_type), 0) + 1,
+              false);
+SELECT setval('public.parameter_parameter_id_seq',
+              COALESCE((SELECT max(parameter_id) FROM public.parameter), 0) + 1,
+              false);
+SELECT setval('public.file_format_file_format_id_seq',
+              COALESCE((SELECT max(file_format_id) FROM public.file_format), 0) + 1,
+              false);
+SELECT setval('public.file_type_file_type_id_seq',
+              COALESCE((SELECT max(file_type_id) FROM public.file_type), 0) + 1,
+              false);
+SELECT setval('public.smhi_srid_seq',
+              GREATEST((SELECT max(srid) FROM public.spatial_ref_sys) + 1, 910000),
+              false);
+
+ALTER TABLE public.boundary ALTER COLUMN boundary_id
+ SET DEFAULT nextval('public.boundary_boundary_id_seq');
+ALTER TABLE public.parameter_type ALTER COLUMN parameter_type_id
+ SET DEFAULT nextval('public.parameter_type_parameter_type_id_seq');
+ALTER TABLE public.parameter ALTER COLUMN parameter_id
+ SET DEFAULT nextval('public.parameter_parameter_id_seq');
+ALTER TABLE public.file_format ALTER COLUMN file_format_id
+ SET DEFAULT nextval('public.file_format_file_format_id_seq');
+ALTER TABLE public.file_type ALTER COLUMN file_type_id
+ SET DEFAULT nextval('public.file_type_file_type_id_seq');
+
+COMMIT;
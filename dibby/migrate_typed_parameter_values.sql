@@ -0,0 +1,98 @@
+-- Add the typed value columns to parameter_value and fill them in for the
+-- existing rows.
+--
+-- The column used for a parameter is chosen from the name of its
+-- parameter_type: 'timestamp' and 'datetime' -> time_value, 'numeric' and
+-- 'int' -> numeric_value, 'interval' -> interval_value. Other types are only
+-- kept as text in data_value.
+--
+-- New parameter types take their id from the sequence of
+-- migrate_id_sequences.sql if it was run already, so the two migrations can
+-- be run in any order.
+
+BEGIN;
+
+ALTER TABLE public.parameter_value ADD COLUMN time_value TIMESTAMP;
+ALTER TABLE public.parameter_value ADD COLUMN numeric_value DOUBLE PRECISION;
+ALTER TABLE public.parameter_value ADD COLUMN interval_value INTERVAL;
+
+INSERT INTO public.parameter_type
+ SELECT CASE WHEN to_regclass('public.parameter_type_parameter_type_id_seq')
+                  IS NULL
+             THEN COALESCE(MAX(parameter_type_id), 0) + 1
+             ELSE nextval(to_regclass(
+                 'public.parameter_type_parameter_type_id_seq'))
+        END, 'timestamp', 'parameter_value'
+ FROM public.parameter_type
+ HAVING COALESCE(NOT bool_or(parameter_type_name = 'timestamp'), TRUE);
+INSERT INTO public.parameter_type
+ SELECT CASE WHEN to_regclass('public.parameter_type_parameter_type_id_seq')
+                  IS NULL
+             THEN COALESCE(MAX(parameter_type_id), 0) + 1
+             ELSE nextval(to_regclass(
+                 'public.parameter_type_parameter_type_id_seq'))
+        END, 'numeric', 'parameter_value'
+ FROM public.parameter_type
+ HAVING COALESCE(NOT bool_or(parameter_type_name = 'numeric'), TRUE);
+INSERT INTO public.parameter_type
+ SELECT CASE WHEN to_regclass('public.parameter_type_parameter_type_id_seq')
+                  IS NULL
+             THEN COALESCE(MAX(parameter_type_id), 0) + 1
+             ELSE nextval(to_regclass(
+                 'public.parameter_type_parameter_type_id_seq'))
+        END, 'interval', 'parameter_value'
+ FROM public.parameter_type
+ HAVING COALESCE(NOT bool_or(parameter_type_name = 'interval'), TRUE);
+
+UPDATE public.parameter p
+ SET parameter_type_id = pt.parameter_type_id
+ FROM public.parameter_type pt
+ WHERE pt.parameter_type_name = 'timestamp'
+   AND p.parameter_name IN ('start_time', 'end_time',
+                            'time_of_first_scanline', 'time_of_last_scanline',
+                            'time_start', 'time_end', 'time_of_analysis');
+UPDATE public.parameter p
+ SET parameter_type_id = pt.parameter_type_id
+ FROM public.parameter_type pt
+ WHERE pt.parameter_type_name = 'numeric'
+   AND p.parameter_name IN ('orbit_number', 'processing_center');
+UPDATE public.parameter p
+ SET parameter_type_id = pt.parameter_type_id
+ FROM public.parameter_type pt
+ WHERE pt.parameter_type_name = 'interval'
+   AND p.parameter_name IN ('forcast_length');
+
+UPDATE public.parameter_value pv
+ SET time_value = pv.data_value::timestamp
+ FROM public.parameter p, public.parameter_type pt
+ WHERE pv.parameter_id = p.parameter_id
+   AND p.parameter_type_id = pt.parameter_type_id
+   AND pt.parameter_type_name IN ('timestamp', 'datetime')
+   AND pv.data_value ~ '^[0-9]{4}-[0-9]{2}-[0-9]{2}';
+UPDATE public.parameter_value pv
+ SET numeric_value = pv.data_value::double precision
+ FROM public.parameter p, public.parameter_type pt
+ WHERE pv.parameter_id = p.parameter_id
+   AND p.parameter_type_id = pt.parameter_type_id
+   AND pt.parameter_type_name IN ('numeric', 'int')
+   AND pv.data_value ~ '^[-+]?[0-9]+(\.[0-9]*)?([eE][-+]?[0-9]+)?$';
+UPDATE public.parameter_value pv
+ SET interval_value = pv.data_value::interval
+ FROM public.parameter p, public.parameter_type pt
+ WHERE pv.parameter_id = p.parameter_id
+   AND p.parameter_type_id = pt.parameter_type_id
+   AND pt.parameter_type_name = 'interval';
+
+CREATE INDEX parameter_value_time_idx
+ ON public.parameter_value
+ ( parameter_id, time_value );
+
+CREATE INDEX parameter_value_numeric_idx
+ ON public.parameter_value
+ ( parameter_id, numeric_value );
+
+CREATE INDEX parameter_value_interval_idx
+ ON public.parameter_value
+ ( parameter_id, interval_value );
+
+COMMIT;
@@ -3,10 +3,8 @@ import os
 import glob
 from datetime import datetime, timedelta
 
-import shapely
-
 import pytroll_db
-from pyorbital import orbital
+from sat_track import TrackService
 
 TIMESTEP = 10 # Time step in seconds used to define the resloution of the ground track
 TLE_LOCATION = "/data/24/saf/polar_in/tle"
@@ -19,6 +17,9 @@ def get_latest_tle():
     tlefile = files[-1] # Take the latest
     return tlefile
 
+tracks = TrackService(tle_file=get_latest_tle, timestep=TIMESTEP,
+                      sat_lookup=sat_lookup)
+
 def add_product(dcm, filename):
     info = filename.split('_')
     satname = info[0]
@@ -40,28 +41,11 @@ def add_product(dcm, filename):
     p = dcm.get_parameter('satellite_name')
     pv = dcm.create_parameter_value(satname, file_obj=nf, parameter=p)
 
-    sat = orbital.Orbital(sat_lookup.get(satname, satname), tle_file=get_latest_tle())
-
-    dt = timedelta(seconds=10)
     print time_start
-    current_time = time_start
-    lonlat_list = []
-    while current_time <= time_end:
-        pos = sat.get_lonlatalt(current_time)
-        lonlat_list.append(pos[:2])
-        current_time += dt
-
-    value = 'LINESTRING ('
-    for i, item in enumerate(lonlat_list):
-        if i == 0:
-            value += '%s %s' % (item[0], item[1])
-        else:
-            value += ' ,%s %s' % (item[0], item[1])
-    value += ')'
+    track = tracks.get_track(satname, time_start, time_end)
 
-    wkt_o = shapely.wkt.loads(value)
     p_track = dcm.get_parameter('sub_satellite_track')
-    pls = dcm.create_parameter_linestring(wkt_o, file_obj=nf, parameter=p_track)
+    pls = dcm.create_parameter_linestring(track, file_obj=nf, parameter=p_track)
 
     dcm.save()
 
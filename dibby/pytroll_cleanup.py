@@ -1,5 +1,6 @@
 import sys
 import os
+import errno
 import glob
 from datetime import datetime, timedelta
 
@@ -23,12 +24,12 @@ def sync_product_db(file_type_name, dirname, glob_filter):
         os.path.basename(item) for item in glob.glob('%s/%s' % (dirname, glob_filter))]
     print 'filenames: ', filename_list
     dcm = pytroll_db.DCManager(DB)
+    filenames = set(filename_list)
     file_type = dcm.get_file_type(file_type_name)
-    file_obj_list = file_type.file_objs
-    for file_obj in file_obj_list:
-        if file_obj.filename not in filename_list:
-            dcm.delete(file_obj)
-    dcm.save()
+    uids = [uid for uid, in dcm.session.query(pytroll_db.File.uid).filter(
+        pytroll_db.File.file_type_id == file_type.file_type_id)
+        if uid not in filenames]
+    print "removed", dcm.delete_files(uids=uids), "files"
 
 
 def clean_old_entries_in_db(file_type_name, timestamp_utc):
@@ -36,19 +37,35 @@ def clean_old_entries_in_db(file_type_name, timestamp_utc):
     than a given threshold"""
 
     dcm = pytroll_db.DCManager(DB)
-    file_list = dcm.get_files(
-        file_type_name, newest_creation_time=timestamp_utc)
-    for file_obj in file_list:
-        dcm.delete(file_obj)
-    dcm.save()
+    print "removed", dcm.delete_files(file_type_name,
+                                      newest_creation_time=timestamp_utc), \
+        "files"
 
 
 import paramiko
 from urlparse import urlparse
-from socket import gaierror
+from socket import gaierror, error as socket_error
 
 logins = {}
 
+# number of ssh connections, and of sftp channels per connection, used to
+# check the files of a host
+CONNECTIONS = 2
+CHANNELS = 4
+
+# age after which the incremental check verifies a uri again
+VERIFICATION_AGE = timedelta(days=7)
+
+# number of uris checked and committed at once by the incremental check
+CHECK_BATCH_SIZE = 10000
+
+# directories with less uris to check than this are not listed, the uris
+# are stat'ed instead
+LIST_MIN_FILES = 3
+
+# (connections, channels) of the hosts, from access.cfg
+host_limits = {}
+
 import ConfigParser
 
 
@@ -61,6 +78,12 @@ def load_logins():
     for host in cfg.sections():
         logins[host] = (cfg.get(host, "username"),
                         cfg.get(host, "password"))
+        connections, channels = CONNECTIONS, CHANNELS
+        if cfg.has_option(host, "connections"):
+            connections = cfg.getint(host, "connections")
+        if cfg.has_option(host, "channels"):
+            channels = cfg.getint(host, "channels")
+        host_limits[host] = connections, channels
 
 
 class ConnectionError(Exception):
@@ -137,143 +160,203 @@ def close_ssh_all():
     del connexion
 
 
-from threading import Thread, Condition
-from Queue import Queue, Empty
-
+from threading import Thread
+from Queue import Queue
 
-class LocalChecker(Thread):
 
-    """Check if a file is there locally.
+def connect_ssh(hostname):
+    """Open an ssh connection to *hostname* with its login.
     """
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    try:
+        username, password = logins[hostname]
+    except KeyError:
+        print "unknown hostname", hostname
+        raise
+    try:
+        ssh.connect(hostname,
+                    username=username,
+                    password=password)
+    except gaierror:
+        raise ConnectionError("Can't access " + hostname
+                              + " as " + str(username))
+    except paramiko.PasswordRequiredException:
+        raise ConnectionError("Password required for user "
+                              + str(username) + " on "
+                              + str(hostname))
+    return ssh
 
-    def __init__(self, queue, returnqueue):
-        Thread.__init__(self)
-        self.queue = queue
-        self.returnqueue = returnqueue
-        self.loop = True
 
-    def stop(self):
-        self.loop = False
+def _is_there(fs, path):
+    """Check if *path* is there, raising if it can't be told, e.g. when the
+    connection dropped or the permission is denied.
+    """
+    try:
+        fs.stat(path)
+    except (IOError, OSError), err:
+        if err.errno != errno.ENOENT:
+            raise
+        return False
+    return True
 
-    def run(self):
-        while self.loop:
-            try:
-                uri = self.queue.get(timeout=1)
-            except Empty:
-                continue
-            parsed = urlparse(uri)
-            self.returnqueue.put((uri, os.path.exists(parsed.path)))
 
+class HostChecker(object):
 
-class SSHChecker(Thread):
+    """Check if the files of a host are there, putting (uri, is_there) in
+    the *results* queue, is_there being None if the check failed.
 
-    """Check if a file is there via SSH.
-    """
+    The queue takes (dirname, uris) tasks: the directory is listed once to
+    check all its uris, unless there are less than LIST_MIN_FILES of them,
+    which are then stat'ed.
 
-    def __init__(self, hostname, queue, returnqueue):
-        Thread.__init__(self)
-        self.queue = queue
-        self.returnqueue = returnqueue
-        self.loop = True
-        self.ssh = paramiko.SSHClient()
-        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        try:
-            username, password = logins[hostname]
-        except KeyError:
-            print "unknown hostname", hostname
-            raise
-        try:
-            self.ssh.connect(hostname,
-                             username=username,
-                             password=password)
-        except gaierror:
-            raise ConnectionError("Can't access " + hostname
-                                  + " as " + str(username))
-        except paramiko.PasswordRequiredException:
-            raise ConnectionError("Password required for user "
-                                  + str(username) + " on "
-                                  + str(hostname))
-        self.ftp = self.ssh.open_sftp()
+    Remote files are checked via *connections* ssh connections of
+    *channels* sftp channels each, every channel having its own thread, so
+    that many requests are in flight at once but never more than
+    connections * channels per host. Local files are checked by *channels*
+    threads.
+    """
 
-    def run(self):
-        while self.loop:
+    def __init__(self, hostname, results, connections=CONNECTIONS,
+                 channels=CHANNELS):
+        self.hostname = hostname
+        self.queue = Queue()
+        self.results = results
+        self._ssh = []
+        self._threads = []
+        if hostname == "localhost":
+            # os has the stat and listdir of an sftp client
+            filesystems = [os] * channels
+        else:
+            filesystems = []
             try:
-                uri = self.queue.get(timeout=1)
-            except Empty:
-                continue
+                for i in range(connections):
+                    ssh = connect_ssh(hostname)
+                    self._ssh.append(ssh)
+                    filesystems.extend(ssh.open_sftp()
+                                       for j in range(channels))
+            except:
+                for ssh in self._ssh:
+                    ssh.close()
+                raise
+        for fs in filesystems:
+            thread = Thread(target=self.run, args=(fs, ))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def run(self, fs):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                break
+            dirname, uris = task
+            paths = [urlparse(uri).path for uri in uris]
             try:
-                parsed = urlparse(uri)
-                self.ftp.stat(parsed.path)
-            except IOError:
-                self.returnqueue.put((uri, False))
-            else:
-                self.returnqueue.put((uri, True))
+                if len(uris) < LIST_MIN_FILES:
+                    res = [_is_there(fs, path) for path in paths]
+                else:
+                    try:
+                        names = set(fs.listdir(dirname))
+                    except (IOError, OSError), err:
+                        if err.errno != errno.ENOENT:
+                            raise
+                        names = set()
+                    res = [os.path.basename(path) in names for path in paths]
+            except Exception, err:
+                print "error checking", dirname, err
+                res = [None] * len(uris)
+            for uri, is_there in zip(uris, res):
+                self.results.put((uri, is_there))
 
     def stop(self):
-        self.loop = False
+        for thread in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        for ssh in self._ssh:
+            ssh.close()
 
-connexions = {}
-returnqueue = Queue()
 
+def check_uris(uris):
+    """Check if the *uris* are there, listing each directory once.
 
-def check_file_threaded(uri):
-    global connexions
-    parsed = urlparse(uri)
-    hostname = parsed.hostname
-    if parsed.scheme == "file":
-        hostname = "localhost"
-        if "localhost" not in connexions:
-            connexions[hostname] = LocalChecker(Queue(), returnqueue)
-            connexions[hostname].start()
-    elif parsed.scheme != "ssh":
-        raise ValueError("Protocol should be ssh, not " + str(parsed.scheme))
-    elif hostname not in connexions:
-        connexions[hostname] = SSHChecker(parsed.hostname,
-                                          Queue(),
-                                          returnqueue)
-        connexions[hostname].start()
-    connexions[hostname].queue.put(uri)
+    Returns a dict of uri to True, False, or None when it could not be
+    checked. The checks are over when as many results as URIs are back.
+    """
+    # uris by directory, by host
+    hosts = {}
+    for uri in uris:
+        parsed = urlparse(uri)
+        if parsed.scheme == "file":
+            hostname = "localhost"
+        elif parsed.scheme == "ssh":
+            hostname = parsed.hostname
+        else:
+            raise ValueError("Protocol should be ssh, not "
+                             + str(parsed.scheme))
+        hosts.setdefault(hostname, {}).setdefault(
+            os.path.dirname(parsed.path), []).append(uri)
+
+    results = Queue()
+    checkers = []
+    values = {}
+    cnt = 0
+    try:
+        for hostname, dirs in hosts.items():
+            try:
+                checker = HostChecker(hostname, results,
+                                      *host_limits.get(hostname,
+                                                       (CONNECTIONS,
+                                                        CHANNELS)))
+            except (ConnectionError, KeyError, socket_error,
+                    paramiko.SSHException):
+                print "Can't connect to", hostname
+                for dir_uris in dirs.values():
+                    values.update((uri, None) for uri in dir_uris)
+                continue
+            checkers.append(checker)
+            for dirname, dir_uris in dirs.items():
+                cnt += len(dir_uris)
+                checker.queue.put((dirname, dir_uris))
+        print "sent", cnt, "requests..."
+        for i in range(cnt):
+            uri, res = results.get()
+            values[uri] = res
+    finally:
+        for checker in checkers:
+            checker.stop()
+    return values
 
 
 def is_there_dict(file_list):
-    cnt = 0
-    for filename in file_list:
-        for uri in filename.uris:
-            cnt += 1
-            check_file_threaded(uri.uri)
-    print "send", cnt, "requests..."
-    values = {}
-    while True:
-        try:
-            res = returnqueue.get(timeout=2)
-        except Empty:
-            for connexion in connexions:
-                connexions[connexion].stop()
-            return values
-        values[res[0]] = res[1]
+    """Check if the URIs of the files of *file_list* are there, see
+    check_uris.
+    """
+    return check_uris(uri.uri for filename in file_list
+                      for uri in filename.uris)
 
 
 def threaded_check_all():
     dcm = pytroll_db.DCManager(DB)
-    file_list = dcm.get_files()
 
     load_logins()
     print "requesting..."
-    result = is_there_dict(file_list)
+    result = is_there_dict(dcm.iter_files())
     cnt = 0
     removed = 0
     print "checking..."
-    for filename in file_list:
+    for filename in dcm.iter_files():
         uris_remove = []
         for uri in filename.uris:
-            try:
-                is_there = result[uri.uri]
-                cnt += 1
-                if not is_there:
-                    removed += 1
-                    uris_remove.append(uri)
-            except KeyError:
+            is_there = result.get(uri.uri)
+            if is_there is None:
                 print "error, skipping", uri.uri
+                continue
+            cnt += 1
+            if not is_there:
+                removed += 1
+                uris_remove.append(uri)
         if len(uris_remove) == len(filename.uris):
             dcm.delete(filename)
         for uri in uris_remove:
@@ -283,13 +366,61 @@ def threaded_check_all():
     print "Removed", removed, "out of", cnt
 
 
+def incremental_check(max_age=VERIFICATION_AGE, priority_hosts=(),
+                      batch_size=CHECK_BATCH_SIZE, remove=True):
+    """Check the URIs not verified for *max_age*, the never verified ones
+    and then the least recently verified ones first, starting with the URIs
+    of the *priority_hosts*, e.g. the hosts known to purge their files.
+
+    The URIs are checked by batches of *batch_size*, and the verification
+    time and status of each batch are committed with it, missing URIs and
+    the files left without URIs being removed if *remove* is True. This is
+    the checkpoint of the run: an interrupted run starts again where it
+    stopped, as the URIs verified so far are not old enough anymore.
+    """
+    dcm = pytroll_db.DCManager(DB)
+
+    load_logins()
+    verified_before = datetime.utcnow() - max_age
+    prefixes = ["ssh://" + host + "/" for host in priority_hosts] + [None]
+    cnt = 0
+    removed = 0
+    for prefix in prefixes:
+        for page in dcm.iter_uris_to_verify(verified_before, prefix,
+                                            batch_size):
+            result = check_uris([file_uri.uri for file_uri in page])
+            now = datetime.utcnow()
+            uids = set()
+            for file_uri in page:
+                is_there = result.get(file_uri.uri)
+                if is_there is None:
+                    print "error, skipping", file_uri.uri
+                    continue
+                cnt += 1
+                file_uri.last_verified = now
+                file_uri.last_status = is_there
+                if not is_there and remove:
+                    print "removing", file_uri.uri
+                    uids.add(file_uri.uid)
+                    dcm.delete(file_uri)
+                    removed += 1
+            dcm.save()
+            if uids:
+                orphans = [uid for uid, in dcm.session.query(
+                    pytroll_db.File.uid).filter(
+                    pytroll_db.File.uid.in_(uids)).filter(
+                    ~pytroll_db.File.uris.any())]
+                dcm.delete_files(uids=orphans)
+            print "checked", cnt, "uris"
+    print "Removed", removed, "out of", cnt
+
+
 def check_all():
     dcm = pytroll_db.DCManager(DB)
-    file_list = dcm.get_files()
 
     load_logins()
 
-    for filename in file_list:
+    for filename in dcm.iter_files():
         uris_remove = []
         for uri in filename.uris:
             try:
@@ -315,4 +446,5 @@ if __name__ == "__main__":
     #sync_product_db("PPS_cloud_type_granule", '/data/24/saf/polar_out/global', 'metop02*_cloudtype.h5')
     #sync_product_db("PPS_cloud_type_granule", '/tmp', 'metop02*_cloudtype.h5')
     # delete_product("metop02_20111110_1346_26252_satproj_00000_01079_cloudtype.h5")
+    # incremental_check(timedelta(days=7), priority_hosts=["pps.smhi.se"])
     threaded_check_all()
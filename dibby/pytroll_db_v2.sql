@@ -1,6 +1,12 @@
+CREATE SEQUENCE public.boundary_boundary_id_seq;
+CREATE SEQUENCE public.parameter_type_parameter_type_id_seq;
+CREATE SEQUENCE public.parameter_parameter_id_seq;
+CREATE SEQUENCE public.file_format_file_format_id_seq;
+CREATE SEQUENCE public.file_type_file_type_id_seq;
+CREATE SEQUENCE public.smhi_srid_seq START 910000;
 
 CREATE TABLE public.boundary (
-                boundary_id INTEGER NOT NULL,
+                boundary_id INTEGER NOT NULL DEFAULT nextval('public.boundary_boundary_id_seq'),
                 boundary_name VARCHAR(255) NOT NULL,
                 boundary geometry(polygon) NOT NULL,
                 creation_time TIMESTAMP NOT NULL,
@@ -9,10 +15,10 @@ CREATE TABLE public.boundary (
 
 CREATE UNIQUE INDEX boundary_idx
  ON public.boundary
- ( boundary_name );
+ ( boundary_name, md5(ST_AsEWKB(boundary)) );
 
 CREATE TABLE public.parameter_type (
-                parameter_type_id INTEGER NOT NULL,
+                parameter_type_id INTEGER NOT NULL DEFAULT nextval('public.parameter_type_parameter_type_id_seq'),
                 parameter_type_name VARCHAR(50) NOT NULL,
                 parameter_location VARCHAR(50) NOT NULL,
                 CONSTRAINT parameter_type_pk PRIMARY KEY (parameter_type_id)
@@ -24,7 +30,7 @@ CREATE UNIQUE INDEX parameter_type_idx
  ( parameter_type_name );
 
 CREATE TABLE public.parameter (
-                parameter_id INTEGER NOT NULL,
+                parameter_id INTEGER NOT NULL DEFAULT nextval('public.parameter_parameter_id_seq'),
                 parameter_type_id INTEGER NOT NULL,
                 parameter_name VARCHAR(50) NOT NULL,
                 description VARCHAR(255) NOT NULL,
@@ -48,7 +54,7 @@ CREATE UNIQUE INDEX tag_idx
  ( tag );
 
 CREATE TABLE public.file_format (
-                file_format_id INTEGER NOT NULL,
+                file_format_id INTEGER NOT NULL DEFAULT nextval('public.file_format_file_format_id_seq'),
                 file_format_name VARCHAR(50) NOT NULL,
                 description VARCHAR(255) NOT NULL,
                 CONSTRAINT file_format_pk PRIMARY KEY (file_format_id)
@@ -60,7 +66,7 @@ CREATE UNIQUE INDEX file_format_idx
  ( file_format_name );
 
 CREATE TABLE public.file_type (
-                file_type_id INTEGER NOT NULL,
+                file_type_id INTEGER NOT NULL DEFAULT nextval('public.file_type_file_type_id_seq'),
                 file_type_name VARCHAR(50) NOT NULL,
                 description VARCHAR(255) NOT NULL,
                 CONSTRAINT file_type_pk PRIMARY KEY (file_type_id)
@@ -84,6 +90,8 @@ CREATE TABLE public.file (
                 file_format_id INTEGER NOT NULL,
                 is_archived BOOLEAN NOT NULL,
                 creation_time TIMESTAMP NOT NULL,
+                start_time TIMESTAMP,
+                end_time TIMESTAMP,
                 CONSTRAINT file_pk PRIMARY KEY (uid)
 );
 
@@ -92,12 +100,41 @@ CREATE INDEX file_idx
  ON public.file
  ( file_type_id, file_format_id );
 
+CREATE INDEX file_creation_idx
+ ON public.file
+ ( creation_time, uid );
+
 CREATE TABLE public.file_uri (
                 uid VARCHAR(255) NOT NULL,
                 uri VARCHAR(255) NOT NULL,
+                last_verified TIMESTAMP,
+                last_status BOOLEAN,
                 CONSTRAINT file_uri_pk PRIMARY KEY (uid, uri)
 );
 
+CREATE INDEX file_uri_verified_idx
+ ON public.file_uri
+ ( last_verified, uid, uri );
+
+CREATE INDEX file_uri_uri_idx
+ ON public.file_uri
+ ( uri varchar_pattern_ops );
+
+
+CREATE TABLE public.enrichment_job (
+                uid VARCHAR(255) NOT NULL,
+                kind VARCHAR(16) NOT NULL,
+                args TEXT,
+                status VARCHAR(16) NOT NULL,
+                attempts INTEGER NOT NULL,
+                updated TIMESTAMP,
+                CONSTRAINT enrichment_job_pk PRIMARY KEY (uid, kind)
+);
+
+CREATE INDEX enrichment_job_status_idx
+ ON public.enrichment_job
+ ( status );
+
 
 CREATE TABLE public.data_boundary (
                 uid VARCHAR(255) NOT NULL,
@@ -119,11 +156,27 @@ CREATE TABLE public.parameter_value (
                 uid VARCHAR(255) NOT NULL,
                 parameter_id INTEGER NOT NULL,
                 data_value VARCHAR(3000) NOT NULL,
+                time_value TIMESTAMP,
+                numeric_value DOUBLE PRECISION,
+                interval_value INTERVAL,
                 creation_time TIMESTAMP NOT NULL,
                 CONSTRAINT parameter_value_pk PRIMARY KEY (uid, parameter_id)
 );
 
 
+CREATE INDEX parameter_value_time_idx
+ ON public.parameter_value
+ ( parameter_id, time_value );
+
+CREATE INDEX parameter_value_numeric_idx
+ ON public.parameter_value
+ ( parameter_id, numeric_value );
+
+CREATE INDEX parameter_value_interval_idx
+ ON public.parameter_value
+ ( parameter_id, interval_value );
+
+
 CREATE TABLE public.file_tag (
                 tag_id INTEGER NOT NULL,
                 uid VARCHAR(255) NOT NULL,
@@ -273,6 +326,15 @@ ON DELETE NO ACTION
 ON UPDATE NO ACTION
 NOT DEFERRABLE;
 
+ALTER TABLE public.enrichment_job ADD CONSTRAINT file_enrichment_job_fk
+FOREIGN KEY (uid)
+REFERENCES public.file (uid)
+ON DELETE CASCADE
+ON UPDATE NO ACTION
+NOT DEFERRABLE;
+
 CREATE INDEX track_gix ON parameter_linestring USING GIST (data_value);
 CREATE INDEX boundary_gix ON boundary USING GIST (boundary);
+CREATE INDEX file_sensing_gix ON file USING GIST (tsrange(start_time, end_time, '[]'))
+ WHERE start_time IS NOT NULL AND end_time IS NOT NULL AND start_time <= end_time;
 
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Martin Raspaud
+
+# Author(s):
+
+#   Martin Raspaud <martin.raspaud@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Bulk load of archived posttroll message logs into the database.
+
+Each line of the logs holding a posttroll message is read, possibly after a
+log prefix, and "dataset" messages are expanded to their files. The
+sub-satellite tracks of a chunk of files are computed in a pool of processes
+while the previous chunk is written with multi-row upserts, in one
+transaction per chunk, so replaying a log twice does no harm. A chunk that
+fails is written again in smaller parts, leaving out only the bad files.
+"""
+
+import sys
+import time
+from multiprocessing import Pool
+from ConfigParser import ConfigParser
+
+from posttroll.message import Message
+from shapely.geometry import LineString
+
+from pytroll_db import DCManager
+from hl_file import get_area_ids
+from enrichment import init_track_process, compute_track, get_msg_area_def
+from db_recorder import sat_lookup, data2record
+
+import logging
+logger = logging.getLogger(__name__)
+
+# number of files written per transaction
+CHUNK_SIZE = 5000
+
+
+def read_messages(filenames):
+    """Read the posttroll messages of the *filenames* logs.
+    """
+    for filename in filenames:
+        with open(filename) as fd_:
+            for line in fd_:
+                start = line.find("pytroll://")
+                if start < 0:
+                    continue
+                try:
+                    yield Message(rawstr=line[start:].rstrip("\n"))
+                except Exception:
+                    logger.warning("Cannot parse: " + line)
+
+
+def expand(msgs):
+    """Get the data of the files announced by *msgs*, leaving out the ones
+    missing sensing times and area.
+    """
+    for msg in msgs:
+        if msg.type == "file":
+            items = [msg.data]
+        elif msg.type == "dataset":
+            items = []
+            for item in msg.data["dataset"]:
+                data = dict(msg.data)
+                del data["dataset"]
+                data.update(item)
+                items.append(data)
+        else:
+            continue
+        for data in items:
+            if (("start_time" not in data or "end_time" not in data) and
+                    "area" not in data):
+                logger.warning("Missing field, not creating record from "
+                               + str(msg))
+                continue
+            yield data
+
+
+def chunks(iterable, size):
+    """Split *iterable* in lists of *size* items.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _compute_track(args):
+    return compute_track(*args)
+
+
+def submit_tracks(pool, chunk):
+    """Start computing the tracks of the *chunk* of file data.
+    """
+    args = [(data["platform_name"], data["start_time"], data["end_time"])
+            if "start_time" in data and "end_time" in data else None
+            for data in chunk]
+    return pool.map_async(_compute_track, [arg for arg in args if arg]), args
+
+
+def load_chunk(dbm, chunk, tracks):
+    """Write the *chunk* of file data and their computed *tracks*, in one
+    transaction if possible.
+
+    If the transaction fails, the chunk is written again in halves, down to
+    single files, so a bad file only loses itself. Returns the number of
+    files written.
+    """
+    result, args = tracks
+    results = iter(result.get())
+    records = []
+    for data, arg in zip(chunk, args):
+        record = data2record(data)
+        if arg is not None:
+            lonlats, error = results.next()
+            if error is not None:
+                logger.warning("Track computation failed for %s:\n%s",
+                               data["uid"], error)
+            elif lonlats is not None:
+                record["sub_satellite_track"] = LineString(lonlats)
+        if "area" in data:
+            try:
+                srid, record["boundary_id"] = get_area_ids(
+                    get_msg_area_def(data["area"]), dbm)
+            except Exception:
+                logger.exception("Skipping %s, bad area", data["uid"])
+                continue
+        records.append(record)
+    return _write(dbm, records)
+
+
+def _write(dbm, records):
+    try:
+        dbm.upsert_files(records, skip_unknown=True)
+        dbm.save()
+    except Exception:
+        dbm.rollback()
+        if len(records) == 1:
+            logger.exception("Skipping %s, could not write it",
+                             records[0]["uid"])
+            return 0
+        logger.warning("Could not write a chunk of %d files, splitting it",
+                       len(records))
+        half = len(records) // 2
+        return _write(dbm, records[:half]) + _write(dbm, records[half:])
+    return len(records)
+
+
+def replay(dbm, filenames, processes=None, chunk_size=CHUNK_SIZE):
+    """Load the messages of the *filenames* logs with *dbm*, computing the
+    tracks in *processes* processes (as many as cpus by default).
+
+    Returns the number of files loaded.
+    """
+    pool = Pool(processes, initializer=init_track_process,
+                initargs=(sat_lookup, ))
+    start = time.time()
+    cnt = 0
+    previous = None
+    try:
+        for chunk in chunks(expand(read_messages(filenames)), chunk_size):
+            current = chunk, submit_tracks(pool, chunk)
+            if previous is not None:
+                cnt += _load(dbm, *previous)
+            previous = current
+        if previous is not None:
+            cnt += _load(dbm, *previous)
+    finally:
+        pool.close()
+        pool.join()
+    logger.info("Loaded %d files in %.1f s", cnt, time.time() - start)
+    return cnt
+
+
+def _load(dbm, chunk, tracks):
+    try:
+        cnt = load_chunk(dbm, chunk, tracks)
+    except Exception:
+        dbm.rollback()
+        logger.exception("Could not load a chunk of %d files", len(chunk))
+        return 0
+    logger.debug("Loaded a chunk of %d files", cnt)
+    return cnt
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print "Usage: %s <db config file> <message log>..." % sys.argv[0]
+        sys.exit(0)
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s %(levelname)s %(name)s] %(message)s")
+
+    config = ConfigParser()
+    config.read(sys.argv[1])
+    mode = config.get("default", "mode")
+    dbm = DCManager(config.get(mode, "uri"))
+    print "Loaded %d files" % replay(dbm, sys.argv[2:])
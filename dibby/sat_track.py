@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Martin Raspaud
+
+# Author(s):
+
+#   Martin Raspaud <martin.raspaud@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Sub-satellite track computation.
+"""
+
+import time
+from threading import Lock
+
+import numpy as np
+from shapely.geometry import LineString
+from pyorbital.orbital import Orbital
+
+import logging
+logger = logging.getLogger(__name__)
+
+# time step in seconds between the points of a track
+TIMESTEP = 10
+
+# age in seconds after which the TLEs of a platform are read again
+TLE_MAX_AGE = 12 * 3600
+
+
+class TrackService(object):
+
+    """Compute sub-satellite tracks, keeping one Orbital per platform.
+
+    The Orbital of a platform is built again, re-reading the TLEs, when it
+    is older than *tle_max_age* seconds. *tle_file* is the TLE file to use,
+    or a function returning it, None meaning the pyorbital default.
+    *sat_lookup* translates platform names to their TLE names.
+    """
+
+    def __init__(self, tle_file=None, tle_max_age=TLE_MAX_AGE,
+                 timestep=TIMESTEP, sat_lookup=None):
+        self.tle_file = tle_file
+        self.tle_max_age = tle_max_age
+        self.timestep = timestep
+        self.sat_lookup = sat_lookup or {}
+        self._orbitals = {}
+        self._lock = Lock()
+
+    def get_orbital(self, platform_name):
+        """Get the Orbital of *platform_name*.
+        """
+        with self._lock:
+            try:
+                orbital, loaded = self._orbitals[platform_name]
+                if time.time() - loaded < self.tle_max_age:
+                    return orbital
+            except KeyError:
+                pass
+            tle_file = self.tle_file
+            if callable(tle_file):
+                tle_file = tle_file()
+            logger.debug("Loading TLEs for " + str(platform_name))
+            orbital = Orbital(self.sat_lookup.get(platform_name,
+                                                  platform_name),
+                              tle_file=tle_file)
+            self._orbitals[platform_name] = orbital, time.time()
+            return orbital
+
+    def get_lonlats(self, platform_name, start_time, end_time):
+        """Get the longitudes and latitudes of *platform_name* every timestep
+        from *start_time*, and at *end_time*.
+        """
+        start_time = np.datetime64(start_time)
+        end_time = np.datetime64(end_time)
+        times = np.arange(start_time, end_time,
+                          np.timedelta64(self.timestep, 's'))
+        times = np.append(times, end_time)
+        lons, lats, alts = self.get_orbital(platform_name).get_lonlatalt(times)
+        return lons, lats
+
+    def get_track(self, platform_name, start_time, end_time):
+        """Get the sub-satellite track of *platform_name* between
+        *start_time* and *end_time* as a linestring, or None if it has less
+        than two points.
+        """
+        lons, lats = self.get_lonlats(platform_name, start_time, end_time)
+        if len(lons) < 2:
+            return None
+        return LineString(np.column_stack((lons, lats)))
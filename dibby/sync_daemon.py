@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Martin Raspaud
+
+# Author(s):
+
+#   Martin Raspaud <martin.raspaud@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Keep the database in sync with the deletions in local directories.
+
+The directories are watched with inotify, and the uris of the files deleted
+or moved away are removed from the database by batches, together with the
+files left without uris. The directories are fully reconciled with the
+database only at startup, and when inotify events were lost.
+
+The configuration file holds the database uri like the one of db_recorder,
+and a "sync" section::
+
+  [sync]
+  directories = /data/polar_in/hrpt, /data/polar_out/global
+  uri_prefixes = file://, ssh://pps.smhi.se/
+
+The uri of a file is one of the uri_prefixes (file:// by default) followed
+by its path.
+"""
+
+import os
+import time
+from threading import Thread, Lock
+from ConfigParser import ConfigParser
+
+import pyinotify
+
+from pytroll_db import DCManager, FileURI
+
+import logging
+logger = logging.getLogger(__name__)
+
+# number of deleted files removed from the database at once
+BATCH_SIZE = 1000
+
+# seconds a deletion waits at most before being removed from the database
+MAX_DELAY = 5
+
+
+class DeletionHandler(pyinotify.ProcessEvent):
+
+    """Collect the paths of the deleted or moved away files.
+    """
+
+    def my_init(self, daemon):
+        self.daemon = daemon
+
+    def process_IN_DELETE(self, event):
+        if not event.dir:
+            self.daemon.add_path(event.pathname)
+
+    process_IN_MOVED_FROM = process_IN_DELETE
+
+    def process_IN_Q_OVERFLOW(self, event):
+        logger.warning("Inotify queue overflow, deletions may be lost")
+        self.daemon.reconcile_later()
+
+
+class SyncDaemon(object):
+
+    """Remove the files deleted from the watched *directories* from the
+    database of *dbm*.
+
+    The uris of a file are the *uri_prefixes* followed by its path. Deleted
+    files are removed by batches of at most *batch_size*, at most
+    *max_delay* seconds after the first one of the batch was deleted.
+    """
+
+    def __init__(self, dbm, directories, uri_prefixes=("file://", ),
+                 batch_size=BATCH_SIZE, max_delay=MAX_DELAY):
+        self.dbm = dbm
+        self.directories = [os.path.normpath(dirname)
+                            for dirname in directories]
+        self.uri_prefixes = uri_prefixes
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.loop = True
+        self._paths = []
+        self._first = None
+        self._reconcile = False
+        self._lock = Lock()
+        self._wm = pyinotify.WatchManager()
+        self._notifier = pyinotify.ThreadedNotifier(
+            self._wm, DeletionHandler(daemon=self))
+        self._thread = Thread(target=self.run)
+
+    def start(self):
+        """Start watching, then reconcile the directories with the database.
+        """
+        self._notifier.start()
+        # watch first, not to miss the deletions made while reconciling
+        self._wm.add_watch(self.directories,
+                           pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM |
+                           pyinotify.IN_Q_OVERFLOW)
+        self.reconcile()
+        self._thread.start()
+
+    def stop(self):
+        """Stop watching, removing the pending deletions first.
+        """
+        self._notifier.stop()
+        self.loop = False
+        self._thread.join()
+
+    def add_path(self, path):
+        """Record the deletion of *path*.
+        """
+        with self._lock:
+            if not self._paths:
+                self._first = time.time()
+            self._paths.append(path)
+
+    def reconcile_later(self):
+        """Reconcile the directories from the flushing thread, e.g. when
+        inotify events were lost.
+        """
+        self._reconcile = True
+
+    def run(self):
+        while self.loop or self._paths:
+            if self._reconcile and self.loop:
+                self._reconcile = False
+                try:
+                    self.reconcile()
+                except Exception:
+                    logger.exception("Could not reconcile")
+                    self.dbm.rollback()
+                    self._reconcile = True
+                    time.sleep(1)
+            elif self._paths and (len(self._paths) >= self.batch_size or
+                                time.time() - self._first >= self.max_delay or
+                                not self.loop):
+                try:
+                    self.flush()
+                except Exception:
+                    logger.exception("Could not remove deleted files")
+                    self.dbm.rollback()
+                    time.sleep(1)
+            else:
+                time.sleep(0.1)
+        self.dbm.close_session()
+
+    def flush(self):
+        """Remove the recorded deletions from the database.
+        """
+        with self._lock:
+            paths = self._paths[:self.batch_size]
+        # leave out the files there again, e.g. created again or renamed
+        # over since they were deleted
+        uris = [prefix + path
+                for path in paths if not os.path.lexists(path)
+                for prefix in self.uri_prefixes]
+        removed = self.dbm.delete_uris(uris)
+        with self._lock:
+            del self._paths[:len(paths)]
+            self._first = time.time()
+        logger.info("Removed %d uris of %d deleted files", removed,
+                    len(paths))
+
+    def reconcile(self):
+        """Remove the uris of the files missing from the directories.
+        """
+        for dirname in self.directories:
+            names = set(os.listdir(dirname))
+            for prefix in self.uri_prefixes:
+                start = prefix + dirname + "/"
+                query = self.dbm.session.query(FileURI.uri).filter(
+                    FileURI.uri.startswith(start))
+                # startswith is a LIKE, where e.g. "_" matches any character,
+                # and files may be added after the listing
+                missing = [uri for uri, in query
+                           if uri.startswith(start) and
+                           "/" not in uri[len(start):] and
+                           uri[len(start):] not in names and
+                           not os.path.lexists(uri[len(prefix):])]
+                self.dbm.rollback()
+                removed = self.dbm.delete_uris(missing)
+                logger.info("Reconciled %s: removed %d uris", start, removed)
+
+
+if __name__ == '__main__':
+    import sys
+    from logging import Formatter
+
+    if len(sys.argv) < 2:
+        print "Usage: %s <config file>" % sys.argv[0]
+        sys.exit(0)
+
+    logger = logging.getLogger("sync_daemon")
+    logger.setLevel(logging.DEBUG)
+
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    formatter = Formatter("[%(asctime)s %(levelname)s %(name)s] %(message)s")
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+
+    config = ConfigParser()
+    config.read(sys.argv[1])
+    mode = config.get("default", "mode")
+    directories = [item.strip()
+                   for item in config.get("sync", "directories").split(",")]
+    uri_prefixes = ("file://", )
+    if config.has_option("sync", "uri_prefixes"):
+        uri_prefixes = [item.strip() for item in
+                        config.get("sync", "uri_prefixes").split(",")]
+
+    daemon = SyncDaemon(DCManager(config.get(mode, "uri")), directories,
+                        uri_prefixes)
+    try:
+        daemon.start()
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        daemon.stop()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Martin Raspaud
+
+# Author(s):
+
+#   Martin Raspaud <martin.raspaud@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The tests package, running without database.
+"""
+
+import unittest
+
+from . import test_spool, test_upsert, test_replay, test_sync
+
+
+def suite():
+    """The global test suite.
+    """
+    mysuite = unittest.TestSuite()
+    mysuite.addTests(test_spool.suite())
+    mysuite.addTests(test_upsert.suite())
+    mysuite.addTests(test_replay.suite())
+    mysuite.addTests(test_sync.suite())
+    return mysuite
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Martin Raspaud
+
+# Author(s):
+
+#   Martin Raspaud <martin.raspaud@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the reading and the loading of the replayed message logs.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from posttroll.message import Message
+
+from ..replay_messages import read_messages, expand, chunks, _write
+
+
+class FakeManager(object):
+
+    """DCManager failing to write the files of *bad* uids.
+    """
+
+    def __init__(self, bad=()):
+        self.bad = set(bad)
+        self.written = []
+        self.attempts = 0
+        self._pending = []
+
+    def upsert_files(self, records, skip_unknown=False):
+        self.attempts += 1
+        if self.bad.intersection(record["uid"] for record in records):
+            raise ValueError("bad file")
+        self._pending = [record["uid"] for record in records]
+
+    def save(self):
+        self.written.extend(self._pending)
+        self._pending = []
+
+    def rollback(self):
+        self._pending = []
+
+
+class TestReadMessages(unittest.TestCase):
+
+    """Test read_messages.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_log(self, name, lines):
+        filename = os.path.join(self.directory, name)
+        with open(filename, "w") as fd_:
+            fd_.write("".join(line + "\n" for line in lines))
+        return filename
+
+    def test_read(self):
+        msg0 = Message("/dibby/test", "file", {"uid": "file0"})
+        msg1 = Message("/dibby/test", "file", {"uid": "file1"})
+        log0 = self.write_log("log0", [
+            "[2015-04-10 12:00:00 INFO recorder] " + str(msg0),
+            "[2015-04-10 12:00:01 INFO recorder] Not a message",
+            "[2015-04-10 12:00:02 INFO recorder] pytroll://corrupt"])
+        log1 = self.write_log("log1", [str(msg1)])
+        msgs = list(read_messages([log0, log1]))
+        self.assertEqual([msg.data["uid"] for msg in msgs],
+                         ["file0", "file1"])
+        self.assertEqual(msgs[0].type, "file")
+
+
+class TestExpand(unittest.TestCase):
+
+    """Test expand.
+    """
+
+    def test_file(self):
+        data = {"uid": "file0", "start_time": 1, "end_time": 2}
+        msgs = [Message("/dibby/test", "file", data),
+                Message("/dibby/test", "del", {"uid": "file1"})]
+        self.assertEqual(list(expand(msgs)), [data])
+
+    def test_dataset(self):
+        msg = Message("/dibby/test", "dataset",
+                      {"platform_name": "NOAA 19", "start_time": 1,
+                       "end_time": 2,
+                       "dataset": [{"uid": "file0", "uri": "/file0"},
+                                   {"uid": "file1", "uri": "/file1",
+                                    "end_time": 3}]})
+        self.assertEqual(list(expand([msg])),
+                         [{"platform_name": "NOAA 19", "uid": "file0",
+                           "uri": "/file0", "start_time": 1, "end_time": 2},
+                          {"platform_name": "NOAA 19", "uid": "file1",
+                           "uri": "/file1", "start_time": 1, "end_time": 3}])
+
+    def test_missing_fields(self):
+        msgs = [Message("/dibby/test", "file",
+                        {"uid": "file0", "start_time": 1}),
+                Message("/dibby/test", "file",
+                        {"uid": "file1", "area": {"area_id": "euron1"}})]
+        self.assertEqual([data["uid"] for data in expand(msgs)], ["file1"])
+
+
+class TestChunks(unittest.TestCase):
+
+    """Test chunks.
+    """
+
+    def test_chunks(self):
+        self.assertEqual(list(chunks(iter(range(5)), 2)),
+                         [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(chunks(range(4), 2)), [[0, 1], [2, 3]])
+        self.assertEqual(list(chunks([], 2)), [])
+
+
+class TestWrite(unittest.TestCase):
+
+    """Test the loading of a chunk with bad files.
+    """
+
+    def test_all_good(self):
+        dbm = FakeManager()
+        records = [{"uid": "file%d" % i} for i in range(8)]
+        self.assertEqual(_write(dbm, records), 8)
+        self.assertEqual(dbm.attempts, 1)
+
+    def test_bad_files_skipped(self):
+        dbm = FakeManager(bad=["file2", "file5"])
+        records = [{"uid": "file%d" % i} for i in range(8)]
+        # only the bad files are lost, not their chunk
+        self.assertEqual(_write(dbm, records), 6)
+        self.assertEqual(dbm.written, ["file0", "file1", "file3", "file4",
+                                       "file6", "file7"])
+
+
+def suite():
+    """The test suite for the replay of message logs.
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestReadMessages))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestExpand))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestChunks))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestWrite))
+    return mysuite
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Martin Raspaud
+
+# Author(s):
+
+#   Martin Raspaud <martin.raspaud@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the spool and the message queue of the recorder.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from Queue import Empty
+from threading import Thread
+
+from posttroll.message import Message
+
+from ..db_recorder import Spool, MessageQueue
+
+
+def make_msg(uid):
+    """Make a file message for *uid*.
+    """
+    return Message("/dibby/test", "file", {"uid": uid})
+
+
+class TestSpool(unittest.TestCase):
+
+    """Test the Spool.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def segments(self):
+        return sorted(os.listdir(self.directory))
+
+    def read_all(self, spool):
+        """Read all the messages of *spool*, as (segment, receipt time, uid).
+        """
+        items = []
+        while True:
+            res = spool.get()
+            if res is None:
+                return items
+            segment, (received, msg) = res
+            items.append((segment, received, msg.data["uid"]))
+
+    def test_write_read(self):
+        spool = Spool(self.directory)
+        for i in range(3):
+            spool.put((100.0 + i, make_msg("file%d" % i)))
+        self.assertEqual(len(spool), 3)
+        self.assertEqual(self.read_all(spool),
+                         [(0, 100.0, "file0"), (0, 101.0, "file1"),
+                          (0, 102.0, "file2")])
+        self.assertEqual(len(spool), 0)
+        self.assertEqual(spool.get(), None)
+        spool.close()
+
+    def test_segments(self):
+        spool = Spool(self.directory, segment_size=2)
+        for i in range(5):
+            spool.put((100.0, make_msg("file%d" % i)))
+        self.assertEqual(self.segments(), ["000000000000.spool",
+                                           "000000000001.spool",
+                                           "000000000002.spool"])
+        items = self.read_all(spool)
+        self.assertEqual([segment for segment, received, uid in items],
+                         [0, 0, 1, 1, 2])
+        self.assertEqual([uid for segment, received, uid in items],
+                         ["file%d" % i for i in range(5)])
+        spool.close()
+
+    def test_done(self):
+        spool = Spool(self.directory, segment_size=2)
+        for i in range(3):
+            spool.put((100.0, make_msg("file%d" % i)))
+        items = self.read_all(spool)
+        # a segment stays until all its messages are acknowledged
+        spool.done(items[0][0])
+        self.assertEqual(len(self.segments()), 2)
+        spool.done(items[1][0])
+        self.assertEqual(self.segments(), ["000000000001.spool"])
+        spool.done(items[2][0])
+        self.assertEqual(self.segments(), [])
+        spool.close()
+
+    def test_read_while_writing(self):
+        spool = Spool(self.directory)
+        spool.put((100.0, make_msg("file0")))
+        segment, (received, msg) = spool.get()
+        spool.put((101.0, make_msg("file1")))
+        # the segment being read is not written to anymore
+        self.assertEqual(self.read_all(spool), [(1, 101.0, "file1")])
+        spool.done(segment)
+        spool.done(1)
+        self.assertEqual(self.segments(), [])
+        spool.close()
+
+    def test_restart(self):
+        spool = Spool(self.directory)
+        for i in range(3):
+            spool.put((100.0, make_msg("file%d" % i)))
+        segment, item = spool.get()
+        spool.done(segment)
+        spool.get()
+        spool.close()
+
+        # read or not, the messages not all acknowledged are read again
+        spool = Spool(self.directory)
+        self.assertEqual(len(spool), 3)
+        items = self.read_all(spool)
+        self.assertEqual([uid for segment, received, uid in items],
+                         ["file0", "file1", "file2"])
+        for segment, received, uid in items:
+            spool.done(segment)
+        spool.close()
+
+        spool = Spool(self.directory)
+        self.assertEqual(len(spool), 0)
+        spool.put((100.0, make_msg("file3")))
+        self.assertEqual(self.segments(), ["000000000000.spool"])
+        spool.close()
+
+    def test_empty_segments_removed(self):
+        open(os.path.join(self.directory, "000000000004.spool"), "w").close()
+        spool = Spool(self.directory)
+        spool.put((100.0, make_msg("file0")))
+        self.assertEqual(self.segments(), ["000000000000.spool"])
+        spool.close()
+
+    def test_corrupt_last_line(self):
+        spool = Spool(self.directory)
+        for i in range(2):
+            spool.put((100.0, make_msg("file%d" % i)))
+        spool.close()
+        # e.g. a crash in the middle of a write
+        with open(os.path.join(self.directory, "000000000000.spool"),
+                  "a") as fd_:
+            fd_.write("102.000000 pytroll://dibby/te")
+
+        spool = Spool(self.directory)
+        self.assertEqual(len(spool), 3)
+        items = self.read_all(spool)
+        self.assertEqual([uid for segment, received, uid in items],
+                         ["file0", "file1"])
+        for segment, received, uid in items:
+            spool.done(segment)
+        self.assertEqual(self.segments(), [])
+        spool.close()
+
+
+class TestMessageQueue(unittest.TestCase):
+
+    """Test the MessageQueue and its backpressure policies.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_bad_policy(self):
+        self.assertRaises(ValueError, MessageQueue, 10, "bogus")
+        self.assertRaises(ValueError, MessageQueue, 10, "spill")
+
+    def test_block(self):
+        queue = MessageQueue(2)
+        queue.put(make_msg("file0"), 100.0)
+        queue.put(make_msg("file1"), 101.0)
+        self.assertEqual(queue.depth, 2)
+        received, msg, segment = queue.get(timeout=0)
+        self.assertEqual((received, msg.data["uid"], segment),
+                         (100.0, "file0", None))
+        self.assertEqual(queue.get(timeout=0)[1].data["uid"], "file1")
+        self.assertRaises(Empty, queue.get, 0)
+
+    def test_drop_oldest(self):
+        queue = MessageQueue(2, "drop_oldest")
+        for i in range(3):
+            queue.put(make_msg("file%d" % i))
+        self.assertEqual(queue.dropped, 1)
+        self.assertEqual(queue.depth, 2)
+        self.assertEqual([queue.get(timeout=0)[1].data["uid"]
+                          for i in range(2)], ["file1", "file2"])
+
+    def test_spill(self):
+        queue = MessageQueue(1, "spill", Spool(self.directory))
+        for i in range(3):
+            queue.put(make_msg("file%d" % i))
+        self.assertEqual(queue.depth, 3)
+        self.assertEqual(queue.spilled, 2)
+        received, msg, segment = queue.get(timeout=0)
+        self.assertEqual((msg.data["uid"], segment), ("file0", None))
+        # spooled messages are kept in order, before the new ones
+        queue.put(make_msg("file3"))
+        self.assertEqual(queue.spilled, 3)
+        uids = []
+        segments = []
+        for i in range(3):
+            received, msg, segment = queue.get(timeout=0)
+            uids.append(msg.data["uid"])
+            segments.append(segment)
+        self.assertEqual(uids, ["file1", "file2", "file3"])
+        self.assertNotIn(None, segments)
+        self.assertRaises(Empty, queue.get, 0)
+        queue.done(segments + [None])
+        self.assertEqual(os.listdir(self.directory), [])
+        queue.close()
+
+    def test_spool_not_waiting(self):
+        queue = MessageQueue(1, "spill", Spool(self.directory))
+        for i in range(5):
+            queue.put(make_msg("file%d" % i))
+        start = time.time()
+        uids = [queue.get(timeout=1)[1].data["uid"] for i in range(5)]
+        # the spool is read without waiting for the queue timeout
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(uids, ["file%d" % i for i in range(5)])
+        start = time.time()
+        self.assertRaises(Empty, queue.get, 0.2)
+        self.assertGreaterEqual(time.time() - start, 0.2)
+        queue.close()
+
+    def test_spill_drains_under_traffic(self):
+        queue = MessageQueue(2, "spill", Spool(self.directory))
+        for i in range(20):
+            queue.put(make_msg("file%d" % i))
+
+        def produce():
+            for i in range(20, 70):
+                queue.put(make_msg("file%d" % i))
+                time.sleep(0.01)
+        producer = Thread(target=produce)
+        start = time.time()
+        producer.start()
+        uids = []
+        segments = []
+        while len(uids) < 70 and time.time() - start < 10:
+            received, msg, segment = queue.get(timeout=1)
+            uids.append(msg.data["uid"])
+            segments.append(segment)
+        producer.join()
+        # the spool is read as fast as new messages come, in order
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(uids, ["file%d" % i for i in range(70)])
+        self.assertEqual(queue.spilled, 0)
+        queue.done(segments)
+        # out of spill mode once the spool is drained
+        queue.put(make_msg("file70"))
+        self.assertEqual(queue.get(timeout=1)[2], None)
+        self.assertEqual(os.listdir(self.directory), [])
+        queue.close()
+
+    def test_not_spooled(self):
+        queue = MessageQueue(1, "spill", Spool(self.directory))
+        queue.put(make_msg("file0"))
+        queue.put(make_msg("file1"))
+        queue.get(timeout=0)
+        # e.g. when stopping, the spool is left for the next start
+        self.assertRaises(Empty, queue.get, 0, False)
+        self.assertEqual(queue.spilled, 1)
+        queue.close()
+
+
+def suite():
+    """The test suite for the spool and the message queue.
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestSpool))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestMessageQueue))
+    return mysuite
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Martin Raspaud
+
+# Author(s):
+
+#   Martin Raspaud <martin.raspaud@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the removal of the deleted files by the sync daemon.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ..sync_daemon import SyncDaemon, DeletionHandler
+
+
+class FakeQuery(object):
+
+    """Query of all the uris, whatever the filter.
+    """
+
+    def __init__(self, uris):
+        self.uris = uris
+
+    def filter(self, *criteria):
+        return self
+
+    def __iter__(self):
+        return iter([(uri, ) for uri in self.uris])
+
+
+class FakeManager(object):
+
+    """DCManager holding a list of uris.
+    """
+
+    def __init__(self, uris=()):
+        self.uris = list(uris)
+        self.deleted = []
+        self.session = self
+
+    def query(self, *columns):
+        return FakeQuery(self.uris)
+
+    def delete_uris(self, uris):
+        self.deleted.append(list(uris))
+        removed = [uri for uri in uris if uri in self.uris]
+        for uri in removed:
+            self.uris.remove(uri)
+        return len(removed)
+
+    def rollback(self):
+        pass
+
+
+class TestSyncDaemon(unittest.TestCase):
+
+    """Test the SyncDaemon, without watching.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.daemons = []
+
+    def tearDown(self):
+        for daemon in self.daemons:
+            daemon._wm.close()
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def touch(self, name):
+        open(self.path(name), "w").close()
+
+    def make_daemon(self, dbm, **kwargs):
+        daemon = SyncDaemon(dbm, [self.directory], **kwargs)
+        self.daemons.append(daemon)
+        return daemon
+
+    def test_flush(self):
+        self.touch("back")
+        dbm = FakeManager()
+        daemon = self.make_daemon(dbm, uri_prefixes=("file://", "ssh://h"))
+        daemon.add_path(self.path("gone"))
+        daemon.add_path(self.path("back"))
+        daemon.flush()
+        # a file there again, e.g. renamed over, is left alone
+        self.assertEqual(dbm.deleted, [["file://" + self.path("gone"),
+                                        "ssh://h" + self.path("gone")]])
+        self.assertEqual(daemon._paths, [])
+
+    def test_flush_batches(self):
+        dbm = FakeManager()
+        daemon = self.make_daemon(dbm, batch_size=2)
+        for name in ["a", "b", "c"]:
+            daemon.add_path(self.path(name))
+        daemon.flush()
+        self.assertEqual(dbm.deleted, [["file://" + self.path("a"),
+                                        "file://" + self.path("b")]])
+        self.assertEqual(daemon._paths, [self.path("c")])
+        daemon.flush()
+        self.assertEqual(dbm.deleted[1], ["file://" + self.path("c")])
+        self.assertEqual(daemon._paths, [])
+
+    def test_reconcile(self):
+        self.touch("here")
+        os.mkdir(self.path("sub"))
+        other = "file://" + self.directory + "_x/gone"
+        uris = ["file://" + self.path("here"),
+                "file://" + self.path("gone"),
+                "file://" + self.path("sub/gone"),
+                other]
+        dbm = FakeManager(uris)
+        self.make_daemon(dbm).reconcile()
+        # only the missing files of the directory itself are removed, even
+        # if the query matches more
+        self.assertEqual(dbm.deleted, [["file://" + self.path("gone")]])
+        self.assertEqual(dbm.uris, [uris[0], uris[2], other])
+
+    def test_overflow(self):
+        daemon = self.make_daemon(FakeManager())
+        DeletionHandler(daemon=daemon).process_IN_Q_OVERFLOW(None)
+        self.assertTrue(daemon._reconcile)
+
+
+def suite():
+    """The test suite for the sync daemon.
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestSyncDaemon))
+    return mysuite
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Martin Raspaud
+
+# Author(s):
+
+#   Martin Raspaud <martin.raspaud@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the statements of the bulk upserts, rendered without database.
+"""
+
+import time
+import unittest
+from datetime import datetime
+
+from shapely.geometry import LineString
+from sqlalchemy.orm.exc import NoResultFound
+
+from ..pytroll_db import (DCManager, File, ParameterValue,
+                          ParameterLinestring, FileType, FileFormat,
+                          Parameter, ParameterType, TRACK_SQL, FILE_UPDATES,
+                          FILE_FILLS)
+
+T0 = datetime(2015, 4, 10, 12, 0)
+T1 = datetime(2015, 4, 10, 12, 5)
+
+
+class FakeSession(object):
+
+    """Session keeping the executed statements.
+    """
+
+    def __init__(self):
+        self.executed = []
+
+    def flush(self):
+        pass
+
+    def execute(self, statement, params=None):
+        self.executed.append((statement.text, params))
+
+
+def make_manager():
+    """Make a DCManager with a filled lookup cache and no database.
+    """
+    dcm = DCManager.__new__(DCManager)
+    dcm._session = FakeSession()
+    dcm._cache_ttl = None
+    dcm._cache_time = time.time()
+    dcm._cache = {
+        FileType: {"HRPT": FileType(1, "HRPT", "")},
+        FileFormat: {"hrpt": FileFormat(1, "hrpt", "")},
+        ParameterType: {
+            "datetime": ParameterType(1, "datetime", "parameter_value"),
+            "int": ParameterType(2, "int", "parameter_value"),
+            "str": ParameterType(3, "str", "parameter_value"),
+            "linestring": ParameterType(4, "linestring",
+                                        "parameter_linestring")},
+        Parameter: {
+            "start_time": Parameter(1, 1, "start_time", ""),
+            "end_time": Parameter(2, 1, "end_time", ""),
+            "orbit_number": Parameter(3, 2, "orbit_number", ""),
+            "platform_name": Parameter(4, 3, "platform_name", ""),
+            "sub_satellite_track": Parameter(5, 4, "sub_satellite_track",
+                                             "")}}
+    return dcm
+
+
+class TestUpsertSQL(unittest.TestCase):
+
+    """Test DCManager._upsert_sql.
+    """
+
+    def setUp(self):
+        self.dcm = make_manager()
+
+    def test_do_nothing(self):
+        params = {}
+        sql = self.dcm._upsert_sql(File.__table__,
+                                   [{"uid": "a", "creation_time": T0}],
+                                   ["uid"], None, params)
+        self.assertEqual(sql, "INSERT INTO file (creation_time, uid) "
+                         "VALUES (:p0, :p1) ON CONFLICT (uid) DO NOTHING")
+        self.assertEqual(params, {"p0": T0, "p1": "a"})
+
+    def test_do_update(self):
+        sql = self.dcm._upsert_sql(File.__table__, [{"uid": "a"}], ["uid"],
+                                   FILE_FILLS, {})
+        self.assertTrue(sql.endswith(
+            "ON CONFLICT (uid) DO UPDATE SET " + ", ".join(FILE_FILLS)))
+
+    def test_merge_duplicates(self):
+        params = {}
+        rows = [{"uid": "a", "start_time": T0, "end_time": None},
+                {"uid": "a", "start_time": None, "end_time": T1},
+                {"uid": "a", "start_time": T1, "end_time": None}]
+        sql = self.dcm._upsert_sql(File.__table__, rows, ["uid"], None,
+                                   params)
+        # one row, the later non-null values winning
+        self.assertEqual(sql.count("("), 3)
+        self.assertEqual(params, {"p0": T1, "p1": T1, "p2": "a"})
+
+    def test_key_order(self):
+        params = {}
+        rows = [{"uid": "b", "parameter_id": 1, "data_value": "1"},
+                {"uid": "a", "parameter_id": 2, "data_value": "2"},
+                {"uid": "a", "parameter_id": 1, "data_value": "3"}]
+        sql = self.dcm._upsert_sql(ParameterValue.__table__, rows,
+                                   ["uid", "parameter_id"], None, params)
+        self.assertIn("(data_value, parameter_id, uid) VALUES "
+                      "(:p0, :p1, :p2), (:p3, :p4, :p5), (:p6, :p7, :p8)",
+                      sql)
+        self.assertEqual([params["p%d" % i] for i in range(9)],
+                         ["3", 1, "a", "2", 2, "a", "1", 1, "b"])
+
+    def test_shared_params(self):
+        params = {"p0": "taken"}
+        sql = self.dcm._upsert_sql(File.__table__, [{"uid": "a"}], ["uid"],
+                                   None, params)
+        self.assertIn("VALUES (:p1)", sql)
+        self.assertEqual(params, {"p0": "taken", "p1": "a"})
+
+    def test_wrappers(self):
+        sql = self.dcm._upsert_sql(ParameterLinestring.__table__,
+                                   [{"uid": "a", "data_value": "wkb"}],
+                                   ["uid"], None, {}, TRACK_SQL)
+        self.assertIn("VALUES (ST_GeogFromWKB(:p0), :p1)", sql)
+
+    def test_sensing_sql(self):
+        row = {"uid": "a", "start_time": T0, "end_time": None}
+        params = {}
+        self.assertEqual(
+            self.dcm._sensing_sql(row, False, params),
+            "UPDATE file SET start_time = COALESCE(start_time, :p1), "
+            "end_time = COALESCE(end_time, :p2) WHERE uid = :p0")
+        self.assertEqual(params, {"p0": "a", "p1": T0, "p2": None})
+        self.assertIn("start_time = COALESCE(:p4, start_time)",
+                      self.dcm._sensing_sql(row, True, params))
+
+
+class TestBulkRows(unittest.TestCase):
+
+    """Test DCManager._bulk_rows.
+    """
+
+    def setUp(self):
+        self.dcm = make_manager()
+
+    def test_file_rows(self):
+        files, sensing, values, uris, tracks, boundaries = \
+            self.dcm._bulk_rows([{"uid": "a", "type": "HRPT",
+                                  "format": "hrpt",
+                                  "parameters": {"start_time": T0,
+                                                 "end_time": T1},
+                                  "URIs": ["file:///a", "ssh://host/a"],
+                                  "boundary_id": 3}], T0)
+        self.assertEqual(files, [{"uid": "a", "file_type_id": 1,
+                                  "file_format_id": 1, "is_archived": False,
+                                  "creation_time": T0, "start_time": T0,
+                                  "end_time": T1}])
+        self.assertEqual(sensing, [])
+        self.assertEqual(uris, [{"uid": "a", "uri": "file:///a"},
+                                {"uid": "a", "uri": "ssh://host/a"}])
+        self.assertEqual(tracks, [])
+        self.assertEqual(boundaries, [{"uid": "a", "boundary_id": 3}])
+
+    def test_typed_columns(self):
+        values = self.dcm._bulk_rows([{"uid": "a",
+                                       "parameters": {"start_time": T0,
+                                                      "orbit_number": 42,
+                                                      "platform_name":
+                                                      "NOAA 19"}}], T0)[2]
+        values = dict((row["parameter_id"], row) for row in values)
+        # all rows have the same columns, for the multi-row INSERT
+        self.assertEqual(set(len(row) for row in values.values()), set([7]))
+        self.assertEqual(values[1]["time_value"], T0)
+        self.assertEqual(values[1]["numeric_value"], None)
+        self.assertEqual(values[3]["numeric_value"], 42)
+        self.assertEqual(values[3]["data_value"], 42)
+        self.assertEqual(values[4]["time_value"], None)
+        self.assertEqual(values[4]["numeric_value"], None)
+        self.assertEqual(values[4]["interval_value"], None)
+
+    def test_sensing_without_type(self):
+        files, sensing = self.dcm._bulk_rows(
+            [{"uid": "a", "parameters": {"start_time": T0}},
+             {"uid": "b", "parameters": {"orbit_number": 1}}], T0)[:2]
+        self.assertEqual(files, [])
+        self.assertEqual(sensing, [{"uid": "a", "start_time": T0,
+                                    "end_time": None}])
+
+    def test_track(self):
+        track = LineString([(0, 0), (1, 1), (2, 3)])
+        tracks = self.dcm._bulk_rows([{"uid": "a",
+                                       "sub_satellite_track": track}], T0)[4]
+        self.assertEqual(len(tracks), 1)
+        self.assertEqual(tracks[0]["parameter_id"], 5)
+        self.assertEqual(str(tracks[0]["data_value"]), track.wkb)
+
+    def test_unknown(self):
+        records = [{"uid": "a", "parameters": {"bogus": 1}}]
+        self.assertRaises(NoResultFound, self.dcm._bulk_rows, records, T0)
+        values = self.dcm._bulk_rows(records, T0, skip_unknown=True)[2]
+        self.assertEqual(values, [])
+        self.assertRaises(NoResultFound, self.dcm._bulk_rows,
+                          [{"uid": "a", "type": "bogus", "format": "hrpt"}],
+                          T0)
+
+
+class TestUpsertFiles(unittest.TestCase):
+
+    """Test the statements sent by DCManager.upsert_files.
+    """
+
+    def setUp(self):
+        self.dcm = make_manager()
+
+    def test_one_round_trip(self):
+        self.dcm.upsert_files([{"uid": "a", "type": "HRPT", "format": "hrpt",
+                                "parameters": {"orbit_number": 1},
+                                "URIs": ["file:///a"]},
+                               {"uid": "b",
+                                "parameters": {"end_time": T1}}],
+                              creation_time=T0)
+        self.assertEqual(len(self.dcm._session.executed), 1)
+        sql, params = self.dcm._session.executed[0]
+        statements = sql.split(";\n")
+        self.assertEqual(len(statements), 4)
+        self.assertTrue(statements[0].startswith("INSERT INTO file "))
+        self.assertTrue(statements[1].startswith("UPDATE file "))
+        self.assertTrue(statements[2].startswith(
+            "INSERT INTO parameter_value "))
+        self.assertTrue(statements[3].startswith("INSERT INTO file_uri "))
+        self.assertEqual(len(params), sum(statement.count(":p")
+                                          for statement in statements))
+
+    def test_fill_sensing_time(self):
+        self.dcm.upsert_files([{"uid": "a", "type": "HRPT", "format": "hrpt",
+                                "parameters": {"start_time": T0}}])
+        sql = self.dcm._session.executed[0][0].split(";\n")[0]
+        self.assertTrue(sql.endswith("DO UPDATE SET " +
+                                     ", ".join(FILE_FILLS)))
+
+    def test_update(self):
+        self.dcm.upsert_files([{"uid": "a", "type": "HRPT", "format": "hrpt",
+                                "parameters": {"orbit_number": 1}}],
+                              update=True)
+        file_sql, value_sql = self.dcm._session.executed[0][0].split(";\n")
+        self.assertTrue(file_sql.endswith("DO UPDATE SET " +
+                                          ", ".join(FILE_UPDATES)))
+        self.assertIn("DO UPDATE SET data_value = EXCLUDED.data_value",
+                      value_sql)
+
+    def test_chunks(self):
+        self.dcm.upsert_files([{"uid": str(i), "type": "HRPT",
+                                "format": "hrpt"} for i in range(5)],
+                              chunk_size=2)
+        self.assertEqual(len(self.dcm._session.executed), 3)
+
+
+def suite():
+    """The test suite for the bulk upserts.
+    """
+    loader = unittest.TestLoader()
+    mysuite = unittest.TestSuite()
+    mysuite.addTest(loader.loadTestsFromTestCase(TestUpsertSQL))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestBulkRows))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestUpsertFiles))
+    return mysuite
+
+if __name__ == '__main__':
+    unittest.main()
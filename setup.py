@@ -29,7 +29,7 @@ version = imp.load_source('dibby.version', 'dibby/version.py')
 
 
 requirements = ['geoalchemy2', 'sqlalchemy==0.8.4', 'pyorbital',
-                'posttroll', 'shapely', 'psycopg2', 'paramiko']
+                'posttroll', 'shapely', 'psycopg2', 'paramiko', 'pyinotify']
 
 setup(name="pytroll-dibby",
       version=version.__version__,
@@ -37,10 +37,12 @@ setup(name="pytroll-dibby",
       author='The pytroll team',
       author_email='martin.raspaud@smhi.se',
       url="http://github.com/mraspaud/doobie",
-      packages=['doobie'],
+      packages=['doobie', 'doobie.tests'],
+      package_dir={'doobie': 'dibby'},
       zip_safe=False,
       license="GPLv3",
       install_requires=requirements,
+      test_suite="dibby.tests.suite",
       classifiers=[
           'Development Status :: 4 - Beta',
           'License :: OSI Approved :: GNU General Public License v3 (GPLv3)',